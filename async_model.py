@@ -0,0 +1,38 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import model
+
+
+def _reader_init():
+    model.use_connection(model.connect(read_only=True))
+
+class AsyncModel:
+    """Runs model functions off the event loop. Reads go to a bounded pool
+    of threads that each hold a read-only connection, so concurrent requests
+    don't queue up behind one slow query; writes are serialized on a single
+    writer thread with its own read/write connection."""
+    def __init__(self, readers=4):
+        self.readers = ThreadPoolExecutor(
+            max_workers=readers, thread_name_prefix="model-read", initializer=_reader_init
+        )
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="model-write")
+
+    def _run(self, pool, fn, *args, **kwargs):
+        return asyncio.get_running_loop().run_in_executor(pool, functools.partial(fn, *args, **kwargs))
+
+    def read(self, fn, *args, **kwargs):
+        return self._run(self.readers, fn, *args, **kwargs)
+
+    def write(self, fn, *args, **kwargs):
+        return self._run(self.writer, fn, *args, **kwargs)
+
+    async def iter_todo_pages(self, **filters):
+        pages = model.iter_todo_pages(**filters)
+        while (page := await self.read(next, pages, None)) is not None:
+            yield page
+
+    def shutdown(self):
+        self.readers.shutdown()
+        self.writer.shutdown()
@@ -0,0 +1,164 @@
+"""Benchmarks for the model layer against a synthetic database.
+
+    python bench.py                      # run and compare against bench_baseline.json
+    python bench.py --save-baseline      # run and record the results as the new baseline
+    python bench.py --depth 5 --fanout 8 --years 3 --threshold 1.5 --no-compare
+
+Each benchmark reports seconds per call, calls per second and peak traced
+memory. Any benchmark slower than baseline * threshold makes the run exit
+non-zero, and so does a missing baseline or one recorded with a different
+config, unless --no-compare is passed.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import model
+import sql
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+
+def _tree(depth, fanout, rng, opts, level=0):
+    res = []
+    for i in range(fanout):
+        todo = {
+            "title": f"todo {level}.{i}",
+            "body": f"body of {level}.{i}" if rng.random() < 0.3 else None,
+            "checked": rng.random() < opts.checked,
+            "deleted": rng.random() < opts.deleted
+        }
+        if level > 0 and rng.random() < opts.recurring:
+            todo["recurrence"] = rng.choice(["daily", "daily", "weekly", "monthly"])
+        if level + 1 < depth:
+            todo["children"] = _tree(depth, fanout, rng, opts, level + 1)
+        res.append(todo)
+    return res
+
+def generate(path, opts):
+    """Build a fresh database at `path` and point the model at it."""
+    if os.path.exists(path):
+        os.remove(path)
+    model.DB_PATH = path
+    model.use_connection(model.connect())
+    model.init()
+    rng = random.Random(opts.seed)
+    ids = model.bulk_add(_tree(opts.depth, opts.fanout, rng, opts))
+    recurring = [el['id'] for el in model.raw_select("SELECT id FROM todos WHERE recurrence IS NOT NULL")]
+    now = datetime.now()
+    days = int(opts.years * 365)
+    def _checks():
+        for todo_id in recurring:
+            for day in range(days, 0, -1):
+                if rng.random() < opts.check_rate:
+                    yield (todo_id, True, (now - timedelta(days=day)).strftime("%Y-%m-%d %H:%M:%S"))
+    with model.conn() as cur:
+        cur.executemany("INSERT INTO checks (todo_id, checked, created) VALUES (?, ?, ?)", _checks())
+    model.rebuild_stats()
+    expanded = rng.sample(ids, min(len(ids), opts.expanded))
+    for todo_id in expanded:
+        model.todo_expand(todo_id)
+    model.flush_ui_state()
+    return ids, recurring
+
+
+def measure(fn, min_time):
+    """Call fn repeatedly for at least min_time seconds; returns (seconds per
+    call, peak traced bytes during a single extra call)."""
+    fn()
+    calls, start = 0, time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < min_time or calls < 3:
+        fn()
+        calls += 1
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed / calls, peak
+
+def benchmarks(ids, recurring, rng):
+    recurring_todos = [model.todo_by(todo_id) for todo_id in recurring[:200]]
+    sample = rng.sample(ids, min(len(ids), 200))
+    toggles = iter(range(10 ** 9))
+    return {
+        "model.todos": model.todos,
+        "model.todo_tree": model.todo_tree,
+        "model.todo_children(root)": lambda: model.todo_children(None),
+        "model._recurred_checks": model._recurred_checks,
+        "model.todo_streak x200": lambda: [model.todo_streak(t) for t in recurring_todos],
+        "model.todo_checked_p x200": lambda: [model.todo_checked_p(t) for t in recurring_todos],
+        "model.todo_by x200": lambda: [model.todo_by(todo_id) for todo_id in sample],
+        "model.todo_update(check)": lambda: model.todo_update(recurring[next(toggles) % len(recurring)], check=True),
+        "model.todo_update(title)": lambda: model.todo_update(sample[0], title=f"renamed {next(toggles)}"),
+        "model.iter_todo_pages": lambda: sum(len(p) for p in model.iter_todo_pages()),
+        "sql.selectQ x1000": lambda: [sql.selectQ("todos", ["id", "title"], where={"id": i, "deleted": False}, order_by="id") for i in range(1000)],
+        "sql.updateQ x1000": lambda: [sql.updateQ("todos", checked=True, where={"id": i}) for i in range(1000)],
+        "sql.insertQ x1000": lambda: [sql.insertQ("checks", todo_id=i, checked=True) for i in range(1000)],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--fanout", type=int, default=7)
+    parser.add_argument("--deleted", type=float, default=0.3, help="fraction of todos marked deleted")
+    parser.add_argument("--checked", type=float, default=0.4, help="fraction of todos marked checked")
+    parser.add_argument("--recurring", type=float, default=0.05, help="fraction of non-root todos with a recurrence")
+    parser.add_argument("--years", type=float, default=2, help="years of check history per recurring todo")
+    parser.add_argument("--check-rate", type=float, default=0.8, help="chance of a check on any given day")
+    parser.add_argument("--expanded", type=int, default=50, help="number of expanded nodes")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds to spend on each benchmark")
+    parser.add_argument("--db", default=None, help="where to build the database (default: a temp file)")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--no-compare", action="store_true", help="just report; don't check against the baseline")
+    parser.add_argument("--threshold", type=float, default=1.5, help="fail when slower than baseline by this factor")
+    opts = parser.parse_args()
+
+    path = opts.db or os.path.join(tempfile.mkdtemp(prefix="todotree-bench-"), "bench.db")
+    start = time.perf_counter()
+    ids, recurring = generate(path, opts)
+    n_checks = model.raw_select("SELECT COUNT(*) AS n FROM checks")[0]['n']
+    print(f"Generated {len(ids)} todos ({len(recurring)} recurring, {n_checks} checks) in {time.perf_counter() - start:.2f}s at {path}")
+
+    results = {}
+    for name, fn in benchmarks(ids, recurring, random.Random(opts.seed)).items():
+        per_call, peak = measure(fn, opts.min_time)
+        results[name] = {"seconds": per_call, "peak_bytes": peak}
+        print(f"  {name:<30} {per_call * 1000:10.3f} ms/call {1 / per_call:10.1f} calls/s {peak / 1024:10.1f} KiB peak")
+
+    config = {k: getattr(opts, k) for k in ("depth", "fanout", "deleted", "checked", "recurring", "years", "check_rate", "expanded", "seed")}
+    if opts.save_baseline:
+        with open(opts.baseline, "w") as f:
+            json.dump({"config": config, "results": results}, f, indent=2, sort_keys=True)
+        print(f"Saved baseline to {opts.baseline}")
+        return 0
+    if opts.no_compare:
+        return 0
+    if not os.path.exists(opts.baseline):
+        print("No baseline to compare against; run with --save-baseline to record one, or pass --no-compare")
+        return 1
+    with open(opts.baseline) as f:
+        baseline = json.load(f)
+    if baseline["config"] != config:
+        print(f"Baseline was recorded with a different config ({baseline['config']}); record a new one or pass --no-compare")
+        return 1
+    regressions = [
+        (name, res["seconds"] / baseline["results"][name]["seconds"])
+        for name, res in results.items()
+        if name in baseline["results"] and res["seconds"] > baseline["results"][name]["seconds"] * opts.threshold
+    ]
+    for name, factor in regressions:
+        print(f"REGRESSION {name}: {factor:.2f}x slower than baseline")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+import argparse
+import contextlib
+import json
+import re
+import sys
+
+import model
+
+
+_OUTLINE_LINE = re.compile(r"^(?P<indent>\s*)(?:[-*+]\s+)?(?:\[(?P<check>[ xX])\]\s+)?(?P<title>.*?)\s*$")
+
+def outline_todos(lines):
+    """Parse an indented outline (one todo per line, optional `-`/`*` bullets
+    and `[ ]`/`[x]` checkboxes) into the nested shape model.bulk_add takes."""
+    roots = []
+    stack = [(-1, {"children": roots})]
+    for line in lines:
+        if not line.strip():
+            continue
+        match = _OUTLINE_LINE.match(line.expandtabs(4))
+        indent = len(match.group("indent"))
+        todo = {"title": match.group("title"), "children": []}
+        if match.group("check"):
+            todo["checked"] = match.group("check") != " "
+        while stack[-1][0] >= indent:
+            stack.pop()
+        stack[-1][1]["children"].append(todo)
+        stack.append((indent, todo))
+    return roots
+
+
+def rebuild_stats(args):
+    model.init()
+    model.rebuild_stats()
+    print("Rebuilt streak and check-count aggregates")
+
+def compact_checks(args):
+    model.init()
+    n = model.compact_checks(args.days)
+    print(f"Rolled up {n} checks older than {args.days} days")
+
+def gc(args):
+    model.init()
+    removed = model.gc_orphans()
+    print("Removed " + ", ".join(f"{n} from {table}" for table, n in removed.items()))
+
+def backup(args):
+    model.init()
+    model.backup(args.path, pages=args.pages)
+    print(f"Backed up to {args.path}")
+
+def export(args):
+    model.init()
+    with contextlib.nullcontext(sys.stdout) if args.file == "-" else open(args.file, "w") as out:
+        for record in model.export_rows():
+            out.write(json.dumps(record) + "\n")
+
+def _format(args):
+    if args.format is not None:
+        return args.format
+    if args.file.endswith((".ndjson", ".jsonl")):
+        return "ndjson"
+    return "json" if args.file.endswith(".json") else "outline"
+
+def import_todos(args):
+    model.init()
+    fmt = _format(args)
+    with open(args.file) as f:
+        if fmt == "ndjson":
+            counts = model.import_rows(json.loads(line) for line in f if line.strip())
+            print("Imported " + ", ".join(f"{n} {table}" for table, n in counts.items()))
+            return
+        if fmt == "json":
+            todos = json.load(f)
+            if isinstance(todos, dict):
+                todos = [todos]
+        else:
+            todos = outline_todos(f)
+    ids = model.bulk_add(todos, parent_id=args.parent_id)
+    print(f"Imported {len(ids)} todos")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="todotree")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser(
+        "rebuild-stats", help="recompute streak and check-count aggregates from the checks table"
+    ).set_defaults(fn=rebuild_stats)
+
+    compact = commands.add_parser(
+        "compact-checks", help="roll old check rows up into per-todo day bitmaps"
+    )
+    compact.add_argument("--days", type=int, default=90, help="keep checks from the last this many days as rows")
+    compact.set_defaults(fn=compact_checks)
+
+    commands.add_parser(
+        "gc", help="shred orphaned todos and drop rows left behind by shredded ones"
+    ).set_defaults(fn=gc)
+
+    back = commands.add_parser("backup", help="copy the database to a file without blocking writers")
+    back.add_argument("path")
+    back.add_argument("--pages", type=int, default=256, help="pages copied per step")
+    back.set_defaults(fn=backup)
+
+    exp = commands.add_parser("export", help="dump todos, checks and UI state as NDJSON")
+    exp.add_argument("file", nargs="?", default="-", help="defaults to stdout")
+    exp.set_defaults(fn=export)
+
+    imp = commands.add_parser("import", help="bulk-import todos from a JSON tree, an indented outline or an NDJSON export")
+    imp.add_argument("file")
+    imp.add_argument(
+        "--format", choices=["json", "outline", "ndjson"], default=None,
+        help="defaults to ndjson for .ndjson/.jsonl files, json for .json files, outline otherwise"
+    )
+    imp.add_argument("--parent-id", type=int, default=None, help="import under this todo instead of at the top level (not for ndjson)")
+    imp.set_defaults(fn=import_todos)
+
+    args = parser.parse_args()
+    args.fn(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+"""Hammer a running server with concurrent clients and report latency.
+
+    python loadtest.py --url http://localhost:8080/v0/todo --clients 32 --seconds 10
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from tornado.httpclient import AsyncHTTPClient
+
+
+def percentile(sorted_vals, p):
+    if not sorted_vals:
+        return float("nan")
+    k = min(len(sorted_vals) - 1, int(round(p / 100 * (len(sorted_vals) - 1))))
+    return sorted_vals[k]
+
+async def client(http, url, deadline, latencies, errors):
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        try:
+            await http.fetch(url, request_timeout=60)
+            latencies.append(time.perf_counter() - start)
+        except Exception:
+            errors.append(time.perf_counter() - start)
+
+async def run(urls, clients, seconds):
+    AsyncHTTPClient.configure(None, max_clients=clients)
+    http = AsyncHTTPClient()
+    results = {url: ([], []) for url in urls}
+    deadline = time.perf_counter() + seconds
+    await asyncio.gather(*(
+        client(http, urls[i % len(urls)], deadline, *results[urls[i % len(urls)]])
+        for i in range(clients)
+    ))
+    for url, (latencies, errors) in results.items():
+        latencies.sort()
+        print(url)
+        print(f"  requests: {len(latencies)} ok, {len(errors)} failed, {len(latencies) / seconds:.1f} req/s")
+        if latencies:
+            print(
+                f"  latency ms: mean {statistics.mean(latencies) * 1000:.1f}"
+                f"  p50 {percentile(latencies, 50) * 1000:.1f}"
+                f"  p95 {percentile(latencies, 95) * 1000:.1f}"
+                f"  p99 {percentile(latencies, 99) * 1000:.1f}"
+                f"  max {latencies[-1] * 1000:.1f}"
+            )
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", action="append", help="may be given more than once; clients are spread across urls")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+    urls = args.url or ["http://localhost:8080/v0/todo", "http://localhost:8080/v0/health"]
+    asyncio.run(run(urls, args.clients, args.seconds))
+
+if __name__ == "__main__":
+    main()
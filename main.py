@@ -1,36 +1,59 @@
+import time
+
+# Taken before anything heavy is imported, so time-to-first-frame covers the
+# Kivy import and window setup too.
+STARTED = time.perf_counter()
+
+import functools
+import heapq
+import sqlite3
+import threading
+from datetime import datetime
+
 import kivy
 
 kivy.require("2.2.1")
 
 from kivy.app import App
-from kivy.clock import Clock
-from kivy.core.text import LabelBase
+from kivy.clock import Clock, mainthread
 from kivy.core.window import Window
-from kivy.graphics.context_instructions import Color
-from kivy.graphics.vertex_instructions import Rectangle
 from kivy.logger import Logger
 from kivy.uix.boxlayout import BoxLayout
-from kivy.uix.button import Button
 from kivy.uix.checkbox import CheckBox
 from kivy.uix.floatlayout import FloatLayout
 from kivy.uix.label import Label
 from kivy.uix.scrollview import ScrollView
-from kivy.uix.textinput import TextInput
 from kivy.uix.treeview import TreeView, TreeViewLabel, TreeViewNode
 
+import metrics
 import model
 
-LabelBase.register(
-    "Inconsolata",
-    fn_regular="./fonts/Inconsolata_Expanded-Bold.ttf",
-    fn_italic="./fonts/Inconsolata_Expanded-Light.ttf",
-    fn_bold="./fonts/Inconsolata_ExtraExpanded-ExtraBold.ttf",
-    fn_bolditalic="./fonts/Inconsolata_ExtraExpanded-Light.ttf"
-)
+# Only what the first frame needs is imported above. The edit dialog's
+# widgets are imported when it is first opened, and the fonts are registered
+# once the tree is ready to use them.
 
 __version__ = "0.0.1"
 
-OPEN = {}
+_FONTS_REGISTERED = False
+
+def register_fonts():
+    global _FONTS_REGISTERED
+    if _FONTS_REGISTERED:
+        return
+    from kivy.core.text import LabelBase
+    LabelBase.register(
+        "Inconsolata",
+        fn_regular="./fonts/Inconsolata_Expanded-Bold.ttf",
+        fn_italic="./fonts/Inconsolata_Expanded-Light.ttf",
+        fn_bold="./fonts/Inconsolata_ExtraExpanded-ExtraBold.ttf",
+        fn_bolditalic="./fonts/Inconsolata_ExtraExpanded-Light.ttf"
+    )
+    _FONTS_REGISTERED = True
+
+def since_start():
+    return (time.perf_counter() - STARTED) * 1000
+
+OPEN = set()
 
 def initialize():
     global OPEN
@@ -46,9 +69,153 @@ _REC_COLORS = {
     "monthly": "#f51df1"
 }
 
+class RenderCache:
+    """Checked state and markup for each todo, computed at most once per
+    `tick` seconds. Entries are keyed on the todo's id and are dropped when
+    its `updated` stamp or check count moves; anything that changes a todo
+    in place should also call invalidate, since `updated` only has second
+    resolution."""
+    def __init__(self, tick=60):
+        self.tick = tick
+        self._epoch = None
+        self._entries = {}
+
+    def _entry(self, todo):
+        epoch = int(time.time() // self.tick)
+        if epoch != self._epoch:
+            self._epoch = epoch
+            self._entries.clear()
+        key = (todo['updated'], todo.get('check_count'))
+        if (entry := self._entries.get(todo['id'])) is None or entry[0] != key:
+            entry = self._entries[todo['id']] = (key, {})
+        return entry[1]
+
+    def get(self, todo, name, fn):
+        entry = self._entry(todo)
+        if name not in entry:
+            metrics.count("main.render_cache.miss")
+            entry[name] = fn(todo)
+        else:
+            metrics.count("main.render_cache.hit")
+        return entry[name]
+
+    def invalidate(self, todo_id):
+        self._entries.pop(todo_id, None)
+
+RENDER = RenderCache()
+
+class RecurrenceScheduler:
+    """Wakes up when a checked recurring todo comes due again (per
+    recurrence.Rule.next_due, i.e. should_recur_p's threshold) and hands it
+    to `on_due`. Keeps a min-heap of due times and a single pending Clock
+    event for the earliest one; re-watching a todo supersedes its old
+    entry. Sleeps are capped so that suspend/resume can't make us miss a
+    flip by much."""
+    MAX_SLEEP = 3600
+
+    def __init__(self, on_due=None):
+        self.on_due = on_due
+        self._heap = []
+        self._due = {}
+        self._event = None
+
+    def watch(self, todo):
+        self._add(todo)
+        self._reschedule()
+
+    def watch_many(self, todos):
+        "watch() each of `todos`, rescheduling once at the end."
+        for todo in todos:
+            self._add(todo)
+        self._reschedule()
+
+    def clear(self):
+        self._heap.clear()
+        self._due.clear()
+        self._reschedule()
+
+    def _add(self, todo):
+        rec, last_checked = todo['recurrence'], model.last_checked_at(todo)
+        if rec and todo['checked'] and last_checked:
+            due = rec.next_due(last_checked)
+            prev = self._due.get(todo['id'])
+            self._due[todo['id']] = (due, todo)
+            if prev is None or prev[0] != due:
+                heapq.heappush(self._heap, (due, todo['id']))
+        else:
+            self._due.pop(todo['id'], None)
+
+    def _current(self, entry):
+        due, todo_id = entry
+        return todo_id in self._due and self._due[todo_id][0] == due
+
+    def _reschedule(self):
+        if len(self._heap) > 2 * len(self._due) + 64:
+            # Superseded entries only get popped once they reach the top
+            self._heap = [(due, todo_id) for todo_id, (due, _) in self._due.items()]
+            heapq.heapify(self._heap)
+        while self._heap and not self._current(self._heap[0]):
+            heapq.heappop(self._heap)
+        if self._event is not None:
+            self._event.cancel()
+            self._event = None
+        if self._heap:
+            delay = (self._heap[0][0] - datetime.now()).total_seconds()
+            self._event = Clock.schedule_once(self._fire, min(max(delay, 0), self.MAX_SLEEP))
+
+    def _fire(self, dt):
+        self._event = None
+        now = datetime.now()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if self._current(entry):
+                due.append(self._due.pop(entry[1])[1])
+        for todo in due:
+            if self.on_due is not None:
+                self.on_due(todo)
+        self._reschedule()
+
+DUE = RecurrenceScheduler()
+
+UI_FLUSH_DELAY = 2
+_UI_FLUSH = None
+
+def try_write(fn, *args, **kwargs):
+    """Run a model write from the UI. If the database stays locked past the
+    busy timeout (say, a long write on another thread), log it and return
+    None, which callers already take as the write not happening."""
+    try:
+        return fn(*args, **kwargs)
+    except sqlite3.OperationalError as e:
+        Logger.warning(f"   == write failed: {e}")
+        return None
+
+def _flush_ui_state(dt=None):
+    # flush_ui_state keeps what it couldn't write, so just try again later
+    try:
+        model.flush_ui_state()
+    except sqlite3.OperationalError as e:
+        Logger.warning(f"   == saving UI state failed, will retry: {e}")
+        schedule_ui_flush()
+
+def schedule_ui_flush():
+    "Debounce writes of expand/filter state; see model.flush_ui_state."
+    global _UI_FLUSH
+    if _UI_FLUSH is not None:
+        _UI_FLUSH.cancel()
+    _UI_FLUSH = Clock.schedule_once(_flush_ui_state, UI_FLUSH_DELAY)
+
+def todo_checked_p(todo):
+    return RENDER.get(todo, 'checked', model.todo_checked_p)
+
+@metrics.timed
 def m_todo_title(todo):
+    return RENDER.get(todo, 'title', _m_todo_title)
+
+def _m_todo_title(todo):
     title = f"[ref=title]{todo['title'].strip() or '__________'}[/ref]"
-    checked = model.todo_checked_p(todo)
+    checked = todo_checked_p(todo)
     if checked:
         title = f"[s]{title}[/s]"
     if todo['recurrence']:
@@ -63,10 +230,14 @@ def m_todo_plus(todo):
 def _link(inst, ref, todo):
     Logger.info(f"LINK -- {ref}")
     if ref == 'check':
-        if updated := model.todo_update(todo['id'], check=(not model.todo_checked_p(todo))):
+        if updated := try_write(model.todo_update, todo['id'], check=(not todo_checked_p(todo))):
             for k, v in updated.items():
                 todo[k] = v
+            RENDER.invalidate(todo['id'])
+            DUE.watch(todo)
             inst.text=m_todo_title(todo)
+            if getattr(inst, 'body_node', None) is not None:
+                inst.body_node.text = body_text(todo)
         else:
             Logger.info(f"   == Checking a TODO failed :(")
     elif ref == 'addchild':
@@ -77,15 +248,20 @@ def _link(inst, ref, todo):
     else:
         inst.show_note_dialog(inst, todo)
 
+@metrics.timed
 def body_text(todo):
+    return RENDER.get(todo, 'body', _body_text)
+
+def _body_text(todo):
     res = []
     if todo['recurrence']:
-        res.append(f"Total : {len(todo['checked_at'] or [])}")
+        res.append(f"Total : {todo['check_count']}")
         res.append(f"Streak: [font=Inconsolata]{''.join(['[x]'] * model.todo_streak(todo))}[ ][/font]")
     if todo['body']:
         res.append(f"[ref=edit][i]{todo['body']}[/i][/ref]")
     return '\n'.join(res)
 
+@metrics.timed
 def add_todo_body(node, todo):
     if todo['body'] or todo['recurrence']:
         body_node = TreeViewLabel(
@@ -97,6 +273,7 @@ def add_todo_body(node, todo):
         node.body_node = body_node
 
 
+@metrics.timed
 def add_todo_node(root, parent, todo):
     node = root.add_node(TreeViewLabel(
         text=m_todo_title(todo),
@@ -106,18 +283,34 @@ def add_todo_node(root, parent, todo):
     node.show_note_dialog = root.show_note_dialog
     node.root = root
     node.todo_id = todo['id']
-    add_todo_body(node, todo)
+    node.todo = todo
+    node.body_node = None
+    root.todo_nodes[todo['id']] = node
+    # Body and child nodes are only built once the node is expanded (see
+    # TodoTree.expand), so show the expander for anything that has them.
+    node.is_leaf = not _expandable_p(todo)
     return node
 
+def _expandable_p(todo):
+    return bool(todo['body'] or todo['recurrence'] or todo.get('children') or todo.get('has_children'))
+
+@metrics.timed
+def load_children(root, todo, filters=None):
+    if todo.get('children') is not None:
+        return todo['children']
+    todo['children'] = [
+        root.todo_nodes[child['id']].todo if child['id'] in root.todo_nodes else child
+        for child in model.todo_children(todo['id'], filters)
+    ]
+    return todo['children']
+
+@metrics.timed
 def add_subtree(root, parent, todo, filter):
     if filter is not None and not filter(todo):
         return None
     node = add_todo_node(root, parent, todo)
     if todo['id'] in OPEN:
         root.toggle_node(node)
-    if todo['children']:
-        for child in todo['children']:
-            add_subtree(root, node, child, filter)
     return node
 
 def _vbox(*elems):
@@ -128,6 +321,11 @@ def _vbox(*elems):
 
 class EditDialog:
     def __init__(self, root):
+        from kivy.graphics.context_instructions import Color
+        from kivy.graphics.vertex_instructions import Rectangle
+        from kivy.uix.button import Button
+        from kivy.uix.textinput import TextInput
+
         self.root = root
         self.container = BoxLayout(orientation="vertical", size_hint=(1, 0.3), pos=(0,Window.height / 2))
         with self.container.canvas.before:
@@ -168,7 +366,9 @@ class EditDialog:
 
     def on_delete(self):
         deleted = not self.current_todo['deleted']
-        model.todo_update(self.current_todo['id'], delete=deleted)
+        if updated := try_write(model.todo_update, self.current_todo['id'], delete=deleted):
+            self.current_todo.update(updated)
+            RENDER.invalidate(self.current_todo['id'])
         if not (model.ui_filters()['Deleted'] == deleted):
             self.target_inst.root.remove_node(self.target_inst)
         self.reset()
@@ -205,7 +405,7 @@ class EditDialog:
             "recurrence": self.get_recurrence()
         }
         Logger.info(f"  CHANGE: {change}")
-        save_res = self.on_save(change)
+        save_res = try_write(self.on_save, change)
         Logger.info(f"  SAVE RES: {save_res}")
         if save_res:
             if self.current_todo is None:
@@ -215,8 +415,10 @@ class EditDialog:
             for k, v in save_res.items():
                 self.current_todo[k] = v
             for k in list(self.current_todo.keys()):
-                if k not in save_res:
+                if k not in save_res and k not in ('children', 'has_children'):
                     del self.current_todo[k]
+            RENDER.invalidate(self.current_todo['id'])
+            DUE.watch(self.current_todo)
             self.target_inst.text = m_todo_title(save_res)
             if hasattr(self.target_inst, 'body_node') and self.target_inst.body_node is not None:
                 Logger.info("HAS BODY_NODE")
@@ -226,7 +428,7 @@ class EditDialog:
                     self.target_inst.body_node = None
                 else:
                     Logger.info("  NEW TEXT")
-                    self.target_inst.body_node.text = self.current_todo['body']
+                    self.target_inst.body_node.text = body_text(self.current_todo)
             else:
                 if self.current_todo['body']:
                     Logger.info("  FRESHLY FILLED BODY, ADDING NODE")
@@ -262,56 +464,254 @@ class EditDialog:
         else:
             self.one_time.active = True
 
-def _filter_from_state():
-    filters = model.ui_filters()
+def _filter_from_state(filters=None):
+    """The Python side of model.filter_condition, for re-checking todos that
+    are already loaded."""
+    if filters is None:
+        filters = model.ui_filters()
     def _filter_todo(todo):
         if filters['Deleted'] and todo['deleted']:
             return True
         elif not todo['deleted']:
             return (
-                (filters['Unchecked'] and not model.todo_checked_p(todo))
-                or (filters['Checked'] and model.todo_checked_p(todo))
+                (filters['Unchecked'] and not todo_checked_p(todo))
+                or (filters['Checked'] and todo_checked_p(todo))
             )
     return _filter_todo
 
+def _walk_loaded(todos):
+    for todo in todos:
+        yield todo
+        yield from _walk_loaded(todo.get('children') or [])
+
 class TodoTree:
-    def __init__(self, parent, pos=None, **rest):
+    def __init__(self, parent, pos=None, todos=None, **rest):
         self.parent = parent
         self.pos = pos or (0,0)
-        self.dialog = EditDialog(parent)
-        self.render(model.todo_tree(), _filter_from_state())
-
-    def re_render(self, todos, filter=None):
+        self._dialog = None
+        self._hidden_due = None
+        DUE.on_due = self.refresh
+        filters = model.ui_filters()
+        self.render(model.todo_tree(filters) if todos is None else todos, filters)
+
+    @property
+    def dialog(self):
+        if self._dialog is None:
+            self._dialog = EditDialog(self.parent)
+        return self._dialog
+
+    def re_render(self, todos, filters=None):
         global OPEN
         OPEN = model.expanded_todos()
         self.remove()
-        self.render(todos, filter)
-
-    def _maybe_node_id(self, node, fn):
+        DUE.clear()
+        self.render(todos, filters)
+
+    def reload(self, filters=None):
+        filters = self.filters if filters is None else filters
+        self.re_render(model.todo_tree(filters), filters)
+
+    def _place(self, node):
+        """Move a freshly (re)attached node to its id-ordered slot among its
+        siblings, keeping the body node first and the top-level [+] last."""
+        siblings = node.parent_node.nodes
+        siblings.remove(node)
+        for i, sibling in enumerate(siblings):
+            if sibling is self.top_level_plus or getattr(sibling, 'todo_id', -1) > node.todo_id:
+                siblings.insert(i, node)
+                return
+        siblings.append(node)
+
+    def _sync(self, todos, parent):
+        """Reconcile the nodes under `parent` against self.filter. Nodes that
+        stay visible are left alone; nodes that drop out are detached along
+        with their subtree, and kept around so they can be re-attached as-is
+        if a later filter brings them back. Only open nodes are descended
+        into, since collapsed ones have no child nodes built."""
+        tree = self.tree
+        for todo in todos:
+            node = tree.todo_nodes.get(todo['id'])
+            if self.filter is not None and not self.filter(todo):
+                if node is not None and node.parent_node is not None:
+                    tree.remove_node(node)
+                continue
+            if node is None:
+                node = add_todo_node(tree, parent, todo)
+                self._place(node)
+                if todo['id'] in OPEN:
+                    tree.toggle_node(node)
+                continue
+            if node.parent_node is None:
+                tree.add_node(node, parent)
+                self._place(node)
+            if node.is_open:
+                self._sync(todo.get('children') or [], node)
+
+    def _merge(self, todos, loaded):
+        """Fold freshly `loaded` todos into the already loaded `todos` list by
+        id. Known todos keep their objects, which the nodes point at; where
+        the fresh load skipped a todo's children, any loaded under the old
+        filter are dropped so expanding it fetches them again."""
+        known = {todo['id']: todo for todo in todos}
+        for fresh in loaded:
+            if (todo := known.get(fresh['id'])) is None:
+                todos.append(fresh)
+                self._watch([fresh])
+            elif (children := fresh.get('children')) is None:
+                todo['children'] = None
+            elif todo.get('children') is None:
+                todo['children'] = children
+                self._watch(children)
+            else:
+                self._merge(todo['children'], children)
+        todos.sort(key=lambda todo: todo['id'])
+
+    @metrics.timed
+    def refilter(self, filters):
+        """Narrowing the filters only detaches nodes. Todos a wider filter
+        lets through may never have been loaded, so widening loads the tree
+        for the new filters and merges it into what's there; either way
+        only nodes that cross the filter are touched."""
+        if self.filters is None:
+            return self.reload(filters)
+        if any(on and not self.filters.get(name) for name, on in filters.items()):
+            self._merge(self.roots, model.todo_tree(filters))
+        self.filters = filters
+        self.filter = _filter_from_state(filters)
+        self._sync(self.roots, None)
+        self._watch_hidden()
+
+    @metrics.timed
+    def expand(self, node):
+        todo = node.todo
+        if node.body_node is None:
+            add_todo_body(node, todo)
+        loaded = todo.get('children') is not None
+        children = load_children(self.tree, todo, self.filters)
+        if not loaded:
+            self._watch(children)
+        self._sync(children, node)
+
+    def _watch(self, todos):
+        DUE.watch_many(_walk_loaded(todos))
+
+    def _watch_hidden(self):
+        """DUE only knows about loaded todos. When the filter is hiding
+        checked ones, reload once the next of those comes due."""
+        if self._hidden_due is not None:
+            self._hidden_due.cancel()
+            self._hidden_due = None
+        filters = self.filters or {}
+        if not filters.get('Unchecked') or filters.get('Checked'):
+            return
+        if (due := model.upcoming_due()) is None:
+            return
+        def _fire(dt):
+            self._hidden_due = None
+            if datetime.now() >= due:
+                self.reload()
+            else:
+                self._watch_hidden()
+        delay = (due - datetime.now()).total_seconds()
+        self._hidden_due = Clock.schedule_once(_fire, min(max(delay, 0), DUE.MAX_SLEEP))
+
+    @metrics.timed
+    def refresh(self, todo):
+        """Re-render a single todo whose checked state may have changed,
+        attaching or detaching its node if it moved across the filter."""
+        RENDER.invalidate(todo['id'])
+        tree = self.tree
+        node = tree.todo_nodes.get(todo['id'])
+        visible = self.filter is None or self.filter(todo)
+        if node is not None and node.parent_node is not None and not visible:
+            tree.remove_node(node)
+            return
+        if node is None or node.parent_node is None:
+            if not visible:
+                return
+            parent = tree.root if todo['parent_id'] is None else tree.todo_nodes.get(todo['parent_id'])
+            if parent is None or not parent.is_open:
+                return
+            if node is None:
+                node = add_todo_node(tree, parent, todo)
+                self._place(node)
+                if todo['id'] in OPEN:
+                    tree.toggle_node(node)
+                return
+            tree.add_node(node, parent)
+            self._place(node)
+        node.text = m_todo_title(todo)
+        if node.body_node is not None:
+            node.body_node.text = body_text(todo)
+
+    def _forget(self, node):
+        for child in node.nodes:
+            self._forget(child)
         if (tid := getattr(node, 'todo_id', None)) is not None:
-            return fn(tid)
-
-    def render(self, todos, filter=None):
+            self.tree.todo_nodes.pop(tid, None)
+
+    @metrics.timed
+    def collapse(self, node):
+        """Drop the child nodes of a collapsed todo. The todos themselves stay
+        loaded, so expanding it again rebuilds them without touching the db."""
+        for child in list(node.nodes):
+            if getattr(child, 'todo_id', None) is not None:
+                self._forget(child)
+                self.tree.remove_node(child)
+        node.is_leaf = not _expandable_p(node.todo)
+
+    def _remember(self, todo, parent_node=None):
+        todo['children'] = []
+        DUE.watch(todo)
+        if parent_node is None:
+            self.roots.append(todo)
+        elif parent_node.todo.get('children') is not None:
+            parent_node.todo['children'].append(todo)
+
+    def _on_expand(self, node):
+        if getattr(node, 'todo_id', None) is not None:
+            OPEN.add(node.todo_id)
+            self.expand(node)
+            model.todo_expand(node.todo_id)
+            schedule_ui_flush()
+
+    def _on_collapse(self, node):
+        if getattr(node, 'todo_id', None) is not None:
+            OPEN.discard(node.todo_id)
+            self.collapse(node)
+            model.todo_collapse(node.todo_id)
+            schedule_ui_flush()
+
+    @metrics.timed
+    def render(self, todos, filters=None):
+        self.filters = filters
+        self.filter = None if filters is None else _filter_from_state(filters)
+        self.roots = todos
+        self.top_level_plus = None
+        self._watch(todos)
         self.scroll = ScrollView(do_scroll_x=False, do_scroll_y=True) # size=(Window.width, Window.height)
         self.tree = TreeView(
             hide_root=True, pos=self.pos, # size_hint=(0.9, 1),
             size_hint_y=None, height=self.scroll.height / 2,
-            on_node_expand=lambda inst, node: self._maybe_node_id(node, model.todo_expand),
-            on_node_collapse=lambda inst, node: self._maybe_node_id(node, model.todo_collapse)
+            on_node_expand=lambda inst, node: self._on_expand(node),
+            on_node_collapse=lambda inst, node: self._on_collapse(node)
         )
         self.tree.show_note_dialog = self.show_note_dialog
+        self.tree.todo_nodes = {}
         for todo in todos:
-            if filter is None or filter(todo):
-                add_subtree(self.tree, None, todo, filter)
+            if self.filter is None or self.filter(todo):
+                add_subtree(self.tree, None, todo, self.filter)
 
         top_level_plus = TreeViewLabel(
             text="[font=Inconsolata][ref=addchild][+][/ref][/font]", markup=True,
             on_ref_press=lambda inst, ev: self.show_note_dialog(inst)
         )
         top_level_plus.root = self.tree
+        self.top_level_plus = top_level_plus
         self.tree.add_node(top_level_plus)
         self.scroll.add_widget(self.tree)
-        self.parent.add_widget(self.scroll)
+        self.parent.add_widget(self.scroll, index=len(self.parent.children))
+        self._watch_hidden()
 
     def remove(self):
         self.parent.remove_widget(self.scroll)
@@ -324,6 +724,7 @@ class TodoTree:
             elif parent_id is None:
                 self.dialog.edit(inst, None, lambda changes: (
                     todo := model.todo_add(changes['title'], body=changes.get('body'), recurrence=changes.get('recurrence'), parent_id=parent_id),
+                    self._remember(todo),
                     tmp := self.tree.children[0],
                     self.tree.remove_node(tmp),
                     add_todo_node(inst.root, None, todo),
@@ -332,6 +733,7 @@ class TodoTree:
             else:
                 self.dialog.edit(inst, None, lambda changes: (
                     todo := model.todo_add(changes['title'], body=changes.get('body'), recurrence=changes.get('recurrence'), parent_id=parent_id),
+                    self._remember(todo, inst),
                     add_todo_node(inst.root, inst, todo),
                 )[0])
             self.parent.add_widget(self.dialog.container)
@@ -347,8 +749,10 @@ def Filters(parent, tree):
 
     def _update_tree():
         unchecked, checked, deleted = [c.active for c in checks]
-        model.ui_filter_update({"Unchecked": unchecked, "Checked": checked, "Deleted": deleted})
-        tree.re_render(model.todo_tree(), _filter_from_state())
+        filters = {"Unchecked": unchecked, "Checked": checked, "Deleted": deleted}
+        model.ui_filter_update(filters)
+        schedule_ui_flush()
+        tree.refilter(filters)
         parent.remove_widget(box)
         parent.add_widget(box)
 
@@ -362,25 +766,94 @@ def Filters(parent, tree):
     parent.add_widget(box)
     return box
 
+def StatsOverlay(parent, interval=1, top=8):
+    "Live view of the slowest timers in `metrics`; only built when metrics are on."
+    label = Label(
+        text="", font_size="10sp", halign="left", valign="top",
+        size_hint=(1, 0.25), pos_hint={"top": 1}, color=(1, 1, 0, 1)
+    )
+    label.bind(size=lambda inst, size: setattr(inst, 'text_size', size))
+
+    def _refresh(dt):
+        timers = metrics.snapshot(top=top)["timers"]
+        label.text = "\n".join(
+            f"{t['total_ms']:9.1f}ms {t['count']:7d}x {t['max_ms']:7.1f}max  {name}"
+            for name, t in timers.items()
+        )
+
+    Clock.schedule_interval(_refresh, interval)
+    parent.add_widget(label)
+    return label
+
 ## TODO - factor out TreeView into separate class
 ##         - give it external methods to re-render on filtering changes
 ##         - contain it as much as possible so that we can get scrolling down trivially by
 ##           wrapping it in a ScrollView later
 
 class TodoTreeApp(App):
+    """Startup is split so the first frame doesn't wait on the database:
+    build() returns a skeleton straight away (the presplash stays up until
+    then), and the model is initialized and the tree loaded on a background
+    thread. The real widgets replace the skeleton once that's done."""
     def on_start(self):
         Logger.info(" == STARTING APP")
+        Window.bind(on_flip=self._on_first_frame)
+
+    def _on_first_frame(self, *args):
+        Window.unbind(on_flip=self._on_first_frame)
+        Logger.info(f" == first frame after {since_start():.0f}ms")
+
+    def on_pause(self):
+        _flush_ui_state()
+        return True
 
     def on_stop(self):
         Logger.info(" == STOPPING APP")
+        try_write(model.flush_ui_state)
 
     def build(self):
-        root = FloatLayout()
-        tree = TodoTree(root)
-        filters = Filters(root, tree)
+        self.root_layout = FloatLayout()
+        self.skeleton = Label(text="Loading...", size_hint=(1, 1))
+        self.root_layout.add_widget(self.skeleton)
+        threading.Thread(target=self._load, name="todotree-load", daemon=True).start()
+        return self.root_layout
 
-        return root
+    def _load(self):
+        try:
+            initialize()
+            todos = model.todo_tree(model.ui_filters())
+        except Exception as e:
+            Logger.exception(" == loading failed")
+            Clock.schedule_once(functools.partial(self._failed, f"{type(e).__name__}: {e}"))
+            return
+        self._loaded(todos)
+        # Nothing on screen depends on this, so it can trail the first render;
+        # it's a write over the whole checks table, so at most once a day.
+        try:
+            model.compact_checks_if_due()
+        except Exception:
+            Logger.exception(" == compacting checks failed")
+
+    def _failed(self, error, dt=None):
+        root = self.root_layout
+        root.remove_widget(self.skeleton)
+        self.skeleton = Label(
+            text=f"Couldn't load your todos.\n\n{error}", size_hint=(1, 1),
+            halign="center", valign="middle"
+        )
+        self.skeleton.bind(size=self.skeleton.setter("text_size"))
+        root.add_widget(self.skeleton)
+
+    @mainthread
+    def _loaded(self, todos):
+        register_fonts()
+        root = self.root_layout
+        root.remove_widget(self.skeleton)
+        tree = TodoTree(root, todos=todos)
+        filters = Filters(root, tree)
+        if metrics.ENABLED:
+            StatsOverlay(root)
+        Logger.info(f" == tree ready after {since_start():.0f}ms")
 
 if __name__ == '__main__':
-    initialize()
     TodoTreeApp().run()
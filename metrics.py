@@ -0,0 +1,111 @@
+"""Opt-in timers and counters for the hot paths.
+
+Off by default; set TODOTREE_METRICS=1 or call enable(). While disabled, a
+@timed function costs one extra call and a flag check, and count() just the
+flag check. SQL statements are counted through trace_sql, which model hooks
+up on each thread's connection the next time that thread uses it after
+enable(). snapshot() returns everything recorded so far, which the app
+shows in its stats overlay and the server serves from /v0/metrics.
+"""
+import functools
+import os
+import threading
+import time
+from collections import defaultdict
+
+
+ENABLED = os.environ.get("TODOTREE_METRICS", "") not in ("", "0")
+
+_LOCK = threading.Lock()
+_TIMERS = defaultdict(lambda: [0, 0.0, 0.0])
+_COUNTERS = defaultdict(int)
+_QUERIES = defaultdict(int)
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+def reset():
+    with _LOCK:
+        _TIMERS.clear()
+        _COUNTERS.clear()
+        _QUERIES.clear()
+
+
+def record(name, seconds):
+    with _LOCK:
+        timer = _TIMERS[name]
+        timer[0] += 1
+        timer[1] += seconds
+        timer[2] = max(timer[2], seconds)
+
+def count(name, n=1):
+    if ENABLED:
+        with _LOCK:
+            _COUNTERS[name] += n
+
+def trace_sql(statement):
+    """For sqlite3.Connection.set_trace_callback. Counts every statement
+    sqlite actually runs, including the ones fired by triggers."""
+    if ENABLED:
+        with _LOCK:
+            _QUERIES[" ".join(statement.split())] += 1
+
+
+class timer:
+    """Context manager timing a block under `name` while enabled. The
+    optional `detail` (e.g. query text) is only joined onto the name when
+    something is actually recorded."""
+    __slots__ = ("name", "detail", "start")
+
+    def __init__(self, name, detail=None):
+        self.name = name
+        self.detail = detail
+        self.start = None
+
+    def __enter__(self):
+        if ENABLED:
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.start is not None:
+            name = self.name if self.detail is None else f"{self.name}: {' '.join(self.detail.split())}"
+            record(name, time.perf_counter() - self.start)
+
+def timed(fn):
+    name = f"{fn.__module__}.{fn.__qualname__}"
+    @functools.wraps(fn)
+    def _timed(*args, **kwargs):
+        if not ENABLED:
+            return fn(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            record(name, time.perf_counter() - start)
+    return _timed
+
+
+def snapshot(top=None):
+    with _LOCK:
+        timers = {
+            name: {
+                "count": n,
+                "total_ms": total * 1000,
+                "mean_ms": total * 1000 / n,
+                "max_ms": worst * 1000
+            }
+            for name, (n, total, worst) in _TIMERS.items()
+        }
+        counters = dict(_COUNTERS)
+        queries = dict(_QUERIES)
+    if top is not None:
+        timers = dict(sorted(timers.items(), key=lambda kv: -kv[1]["total_ms"])[:top])
+        queries = dict(sorted(queries.items(), key=lambda kv: -kv[1])[:top])
+    return {"enabled": ENABLED, "timers": timers, "counters": counters, "queries": queries}
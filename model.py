@@ -1,19 +1,64 @@
+import functools
+import heapq
 import itertools
+import operator
 import os
 import sqlite3
-from collections import defaultdict
-from datetime import datetime
-
-import plyer
+import threading
+import time
+from array import array
+from collections import OrderedDict, defaultdict
+from contextlib import closing
+from datetime import date, datetime, timedelta
 
+import metrics
 import recurrence as recurr
 import sql
 
-DB_PATH = os.path.join(plyer.storagepath.get_documents_dir(), "todotree.db")
-CONN = sqlite3.connect(DB_PATH)
+# Resolved on first connect rather than at import; the storage lookup goes
+# through pyjnius on Android and is a noticeable chunk of startup. Assign it
+# directly to use a different database.
+DB_PATH = None
+
+def db_path():
+    global DB_PATH
+    if DB_PATH is None:
+        import plyer
+        DB_PATH = os.path.join(plyer.storagepath.get_documents_dir(), "todotree.db")
+    return DB_PATH
+
+# Every thread gets its own connection, opened on first use. Worker pools
+# (see async_model) install theirs up front through use_connection.
+_LOCAL = threading.local()
+
+def connect(read_only=False):
+    if read_only:
+        c = sqlite3.connect(f"file:{db_path()}?mode=ro", uri=True)
+    else:
+        c = sqlite3.connect(db_path())
+        c.execute("PRAGMA journal_mode=WAL")
+    if metrics.ENABLED:
+        c.set_trace_callback(metrics.trace_sql)
+    return c
+
+def use_connection(c):
+    _LOCAL.conn = c
+
+def conn():
+    if (c := getattr(_LOCAL, "conn", None)) is None:
+        c = _LOCAL.conn = connect()
+    # A connection can only be touched from its own thread, so one opened
+    # before metrics.enable() picks up SQL tracing on its next use here.
+    if metrics.ENABLED and getattr(_LOCAL, "traced", None) is not c:
+        c.set_trace_callback(metrics.trace_sql)
+        _LOCAL.traced = c
+    return c
+
+_CHUNK = 500
+_COLUMNS = {}
 
 def init():
-    with CONN as cur:
+    with conn() as cur:
         cur.execute(sql.createQ("todos", [
             "id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL",
             "parent_id INTEGER",
@@ -42,99 +87,481 @@ def init():
             cur.execute(*sql.insertQ("ui_filters", name="Deleted"))
         except sqlite3.IntegrityError:
             pass
+    migrate()
+    _COLUMNS.clear()
+    clear_cache()
 
 def _drop():
-    with CONN as cur:
+    clear_cache()
+    with conn() as cur:
         cur.execute("DROP TABLE todos")
         cur.execute("DROP TABLE checks")
         cur.execute("DROP TABLE ui_expand")
         cur.execute("DROP TABLE ui_filters")
+        cur.execute("DROP TABLE todo_stats")
+        cur.execute("DROP TABLE schema_version")
+        cur.execute("DROP TABLE data_version")
+        cur.execute("DROP TABLE changes")
+        cur.execute("DROP TABLE IF EXISTS todos_fts")
+        cur.execute("DROP TABLE check_rollups")
+        cur.execute("DROP TABLE meta")
+
 
+def table_columns(table_name):
+    if (columns := _COLUMNS.get(table_name)) is None:
+        columns = tuple(el[1] for el in conn().execute(f"PRAGMA table_info({table_name})").fetchall())
+        _COLUMNS[table_name] = columns
+    return columns
 
+@metrics.timed
 def select(table_name, columns, where=None, join=None, order_by=None, transform=None):
-    with CONN as cur:
+    with conn() as cur:
         c = cur.cursor()
         if columns is None or columns == "*":
-            columns = [el[1] for el in c.execute(f"PRAGMA table_info({table_name})").fetchall()]
+            columns = table_columns(table_name)
         elif isinstance(columns, str):
             columns = [columns]
         query, args = sql.selectQ(table_name, columns, where=where, join=join, order_by=order_by)
-        c.execute(query, args)
-        res = (dict(zip(columns, vals)) for vals in c.fetchall())
+        with metrics.timer("sql", query):
+            rows = c.execute(query, args).fetchall()
+        res = (dict(zip(columns, vals)) for vals in rows)
         if transform is not None:
             return [transform(el) for el in res]
         return list(res)
 
+@metrics.timed
+def raw_select(query, args=(), transform=None, factory=None):
+    """Rows of `query` as dicts, or as whatever the sqlite3 row_factory
+    `factory` builds from them."""
+    with conn() as cur:
+        c = cur.cursor()
+        if factory is not None:
+            c.row_factory = factory
+        with metrics.timer("sql", query):
+            rows = c.execute(query, args).fetchall()
+        metrics.count("model.rows_loaded", len(rows))
+        if factory is None:
+            columns = [el[0] for el in c.description]
+            rows = [dict(zip(columns, vals)) for vals in rows]
+        if transform is not None:
+            return [transform(el) for el in rows]
+        return rows
+
+@metrics.timed
 def update(table_name, bindings, where):
-    with CONN as cur:
+    with conn() as cur:
         c = cur.cursor()
         q, args = sql.updateQ(table_name, **{**bindings, "where": where})
-        c.execute(q, args)
+        with metrics.timer("sql", q):
+            c.execute(q, args)
+
+
+## Todo records
+# Loaded todos are slotted records built straight from the cursor by
+# _todo_row, rather than a dict per row that then gets copied and patched.
+# They keep the dict-style interface the UI and server were written against.
+# Check histories are arrays of epoch seconds (UTC, like checks.created);
+# use last_checked_at for the latest one as a datetime.
+_UNSET = object()
+
+class Todo:
+    """A todo row. `t['title']`, `t.get(...)`, `keys()`, `items()`, `update()`,
+    `del` and `dict(t)` behave as they did for the old row dicts; a field that was
+    never set (or was deleted) reads as missing. Every slot is always
+    assigned, with _UNSET standing in for missing, so copies are cheap."""
+    __slots__ = (
+        "id", "parent_id", "title", "body", "recurrence", "checked", "deleted",
+        "created", "updated", "next_due_at", "check_count", "streak",
+        "longest_streak", "last_check_day", "has_children", "children", "checked_at"
+    )
+    FIELDS = frozenset(__slots__)
+
+    def __init__(
+            self, id=_UNSET, parent_id=_UNSET, title=_UNSET, body=_UNSET,
+            recurrence=_UNSET, checked=_UNSET, deleted=_UNSET, created=_UNSET,
+            updated=_UNSET, next_due_at=_UNSET, check_count=_UNSET, streak=_UNSET,
+            longest_streak=_UNSET, last_check_day=_UNSET, has_children=_UNSET,
+            children=_UNSET, checked_at=_UNSET):
+        self.id = id
+        self.parent_id = parent_id
+        self.title = title
+        self.body = body
+        self.recurrence = recurrence
+        self.checked = checked
+        self.deleted = deleted
+        self.created = created
+        self.updated = updated
+        self.next_due_at = next_due_at
+        self.check_count = check_count
+        self.streak = streak
+        self.longest_streak = longest_streak
+        self.last_check_day = last_check_day
+        self.has_children = has_children
+        self.children = children
+        self.checked_at = checked_at
+
+    def __getitem__(self, key):
+        if key in self.FIELDS and (val := getattr(self, key)) is not _UNSET:
+            return val
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        self[key]
+        setattr(self, key, _UNSET)
+
+    def __contains__(self, key):
+        return key in self.FIELDS and getattr(self, key) is not _UNSET
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
 
+    def get(self, key, default=None):
+        if key in self.FIELDS and (val := getattr(self, key)) is not _UNSET:
+            return val
+        return default
 
+    def pop(self, key, *default):
+        if key not in self and default:
+            return default[0]
+        val = self[key]
+        setattr(self, key, _UNSET)
+        return val
+
+    def update(self, other=(), **kw):
+        for key, value in (other.items() if hasattr(other, "keys") else other):
+            self[key] = value
+        for key, value in kw.items():
+            self[key] = value
+
+    def keys(self):
+        return [k for k, v in zip(self.__slots__, _todo_fields(self)) if v is not _UNSET]
+
+    def values(self):
+        return [v for v in _todo_fields(self) if v is not _UNSET]
+
+    def items(self):
+        return [(k, v) for k, v in zip(self.__slots__, _todo_fields(self)) if v is not _UNSET]
+
+    def copy(self):
+        return Todo(*_todo_fields(self))
+
+    def __repr__(self):
+        return f"Todo({', '.join(f'{k}={v!r}' for k, v in self.items())})"
+
+_todo_fields = operator.attrgetter(*Todo.__slots__)
+
+@functools.lru_cache(maxsize=32)
+def _todo_layout(description):
+    """An itemgetter pulling Todo's fields, in slot order, out of a row with
+    _UNSET appended (which stands in for columns the query didn't select),
+    plus where the tree-only columns are."""
+    names = tuple(el[0] for el in description)
+    missing = len(names)
+    fields = operator.itemgetter(*(names.index(k) if k in names else missing for k in Todo.__slots__))
+    loaded = names.index("loaded") if "loaded" in names else None
+    return fields, "has_children" in names, loaded
+
+_PAD = (_UNSET,)
+
+def _todo_row(cursor, row):
+    """sqlite3 row_factory for todo queries (todos.* plus the stats columns).
+    Tree queries also select has_children, and `loaded` for whether the
+    children came along; those get `children` set to [] or None."""
+    fields, tree, loaded = _todo_layout(cursor.description)
+    t = Todo(*fields(row + _PAD))
+    t.checked = bool(t.checked)
+    t.deleted = bool(t.deleted)
+    t.created = datetime.fromisoformat(t.created)
+    t.updated = datetime.fromisoformat(t.updated)
+    if t.next_due_at is not None:
+        t.next_due_at = datetime.fromisoformat(t.next_due_at)
+    if t.recurrence:
+        t.recurrence = recurr.from_string(t.recurrence)
+    if t.last_check_day is not None:
+        t.last_check_day = date.fromisoformat(t.last_check_day)
+    if tree:
+        t.has_children = bool(t.has_children)
+        t.children = [] if loaded is not None and row[loaded] else None
+    return t
+
+_EPOCH = datetime(1970, 1, 1)
+
+def from_epoch(seconds):
+    "A checked_at entry as a naive UTC datetime, matching checks.created."
+    return _EPOCH + timedelta(seconds=seconds)
+
+def last_checked_at(todo):
+    if checked_at := todo.get('checked_at'):
+        return from_epoch(checked_at[-1])
+
+@metrics.timed
 def _transform_todo(raw):
     for btype in ['checked', 'deleted']:
         raw[btype] = bool(raw[btype])
-    for dttype in ['created', 'updated']:
-        if type(raw[dttype]) is str:
+    for dttype in ['created', 'updated', 'next_due_at']:
+        if type(raw.get(dttype)) is str:
             raw[dttype] = datetime.fromisoformat(raw[dttype])
     if rec := raw['recurrence']:
         raw['recurrence'] = recurr.from_string(rec)
+    if type(raw.get('last_check_day')) is str:
+        raw['last_check_day'] = date.fromisoformat(raw['last_check_day'])
     return raw
 
-def _recurred_checks():
-    res = defaultdict(list)
-    checks = select(
-        "checks", ["checks.todo_id", "checks.created"],
-        join=("todos", "todo_id", "todos.id"),
-        where=("todos.recurrence", "IS NOT", None)
-    )
-    for el in checks:
-        res[el['checks.todo_id']].append(datetime.fromisoformat(el['checks.created']))
+_CHECK_EPOCH = "CAST(strftime('%s', checks.created) AS INTEGER)"
+
+@functools.lru_cache(maxsize=32)
+def _checks_in_q(n):
+    return f"SELECT todo_id, {_CHECK_EPOCH} FROM checks WHERE todo_id IN ({', '.join('?' for _ in range(n))}) ORDER BY id"
+
+_RECURRED_CHECKS_Q = f"""SELECT checks.todo_id, {_CHECK_EPOCH} FROM checks
+JOIN todos ON todos.id = checks.todo_id
+WHERE todos.recurrence IS NOT NULL ORDER BY checks.id"""
+_CHECKS_OF_Q = f"SELECT {_CHECK_EPOCH} FROM checks WHERE todo_id = ? ORDER BY id"
+
+@metrics.timed
+def _recurred_checks(todo_ids=None):
+    res = defaultdict(lambda: array('q'))
+    with conn() as cur:
+        c = cur.cursor()
+        if todo_ids is None:
+            chunks = [(None, _RECURRED_CHECKS_Q, ())]
+        else:
+            todo_ids = list(todo_ids)
+            chunks = [
+                (chunk, _checks_in_q(len(chunk)), tuple(chunk))
+                for chunk in (todo_ids[i:i + _CHUNK] for i in range(0, len(todo_ids), _CHUNK))
+            ]
+        for chunk, query, args in chunks:
+            for todo_id, days in _rollups(c, chunk):
+                res[todo_id].extend(days)
+            with metrics.timer("sql", query):
+                for todo_id, created in c.execute(query, args):
+                    res[todo_id].append(created)
     return dict(res)
 
+@metrics.timed
 def _checks_of(todo_id):
-    return [datetime.fromisoformat(el['checks.created']) for el in select("checks", "checks.created", where={"todo_id": todo_id})]
+    with _CACHE_LOCK:
+        if (checks := _CHECK_CACHE.get(todo_id)) is not None:
+            _CHECK_CACHE.move_to_end(todo_id)
+            metrics.count("model.check_cache.hit")
+            return checks
+    metrics.count("model.check_cache.miss")
+    with conn() as cur:
+        checks = array('q')
+        for _, days in _rollups(cur, (todo_id,)):
+            checks.extend(days)
+        checks.extend(el[0] for el in cur.execute(_CHECKS_OF_Q, (todo_id,)))
+    with _CACHE_LOCK:
+        _CHECK_CACHE[todo_id] = checks
+        while len(_CHECK_CACHE) > CHECK_CACHE_SIZE:
+            _CHECK_CACHE.popitem(last=False)
+    return checks
 
+_STATS_COLUMNS = """COALESCE(todo_stats.check_count, 0) AS check_count,
+       COALESCE(todo_stats.streak, 0) AS streak,
+       COALESCE(todo_stats.longest_streak, 0) AS longest_streak,
+       todo_stats.last_check_day AS last_check_day"""
+_STATS_JOIN = "LEFT JOIN todo_stats ON todo_stats.todo_id = todos.id"
+_TODO_SELECT = f"SELECT todos.*, {_STATS_COLUMNS} FROM todos {_STATS_JOIN}"
+_TODO_BY_Q = f"{_TODO_SELECT} WHERE todos.id = ?"
+
+@metrics.timed
 def todos():
     checks = _recurred_checks()
-    return [{**t, **{"checked_at": checks.get(t['id'])}} for t in select("todos", "*", transform=_transform_todo)]
+    res = raw_select(_TODO_SELECT, factory=_todo_row)
+    for t in res:
+        t.checked_at = checks.get(t.id)
+    return res
 
-def todo_tree():
-    node_map = {}
+## Paging
+# Keyset pagination over todos.id, with the filters pushed into SQL. Pass
+# parent_id=None for top-level todos; leave it out to get every parent.
+_ANY = object()
+
+@functools.lru_cache(maxsize=32)
+def _page_q(conditions):
+    return f"{_TODO_SELECT} WHERE {' AND '.join(conditions)} ORDER BY todos.id LIMIT ?"
+
+@metrics.timed
+def todos_page(after_id=0, limit=100, parent_id=_ANY, checked=None, deleted=None, now=None):
+    conditions, args = ["todos.id > ?"], [after_id]
+    if parent_id is not _ANY:
+        conditions.append("todos.parent_id IS ?")
+        args.append(parent_id)
+    if checked is not None:
+        # Same meaning as the UI filters: a recurring todo that has come due
+        # counts as unchecked.
+        conditions.append(_CHECKED if checked else f"NOT {_CHECKED}")
+        args.append((now or datetime.now()).strftime("%Y-%m-%d %H:%M:%S"))
+    if deleted is not None:
+        conditions.append("COALESCE(todos.deleted, 0) = ?")
+        args.append(int(deleted))
+    args.append(limit)
+    return _attach_checks(raw_select(_page_q(tuple(conditions)), tuple(args), factory=_todo_row))
+
+def iter_todo_pages(after_id=0, limit=None, page_size=200, **filters):
+    while limit is None or limit > 0:
+        size = page_size if limit is None else min(page_size, limit)
+        page = todos_page(after_id=after_id, limit=size, **filters)
+        if not page:
+            return
+        yield page
+        if len(page) < size:
+            return
+        after_id = page[-1]['id']
+        if limit is not None:
+            limit -= len(page)
+
+## Filters
+# The UI's Unchecked/Checked/Deleted filters (a ui_filters() dict) as a
+# WHERE condition, so hidden todos never leave sqlite. A todo counts as
+# checked until its next_due_at passes, same as todo_checked_p; `now` is
+# compared in the same terms should_recur_p uses.
+_NOT_DELETED = "NOT IFNULL(todos.deleted, 0)"
+_CHECKED = "(IFNULL(todos.checked, 0) AND (todos.next_due_at IS NULL OR todos.next_due_at > ?))"
+
+def filter_condition(filters, now=None):
+    if filters is None:
+        return "1", ()
+    now = (now or datetime.now()).strftime("%Y-%m-%d %H:%M:%S")
+    conditions, args = [], ()
+    if filters.get('Unchecked') and filters.get('Checked'):
+        conditions.append(_NOT_DELETED)
+    elif filters.get('Unchecked'):
+        conditions.append(f"{_NOT_DELETED} AND NOT {_CHECKED}")
+        args = (now,)
+    elif filters.get('Checked'):
+        conditions.append(f"{_NOT_DELETED} AND {_CHECKED}")
+        args = (now,)
+    if filters.get('Deleted'):
+        conditions.append("IFNULL(todos.deleted, 0)")
+    if not conditions:
+        return "0", ()
+    return " OR ".join(f"({c})" for c in conditions), args
+
+## Lazy tree loading
+# Only roots and the children of expanded nodes are pulled out of the
+# database. Nodes whose children weren't loaded get `children = None`;
+# `has_children` tells the UI whether there's anything to fetch on expand.
+# Todos failing the filter aren't loaded, and neither is anything under them.
+_HAS_CHILDREN = "EXISTS(SELECT 1 FROM todos AS c WHERE c.parent_id = todos.id) AS has_children"
+
+@functools.lru_cache(maxsize=16)
+def _visible_tree_q(condition):
+    return f"""
+WITH RECURSIVE visible(id, open) AS (
+  SELECT id, id IN (SELECT todo_id FROM ui_expand) FROM todos
+  WHERE parent_id IS NULL AND ({condition})
+  UNION
+  SELECT todos.id, todos.id IN (SELECT todo_id FROM ui_expand)
+  FROM visible JOIN todos ON todos.parent_id = visible.id
+  WHERE visible.open AND ({condition})
+)
+SELECT todos.*, visible.open AS loaded, {_HAS_CHILDREN}, {_STATS_COLUMNS}
+FROM visible JOIN todos ON todos.id = visible.id {_STATS_JOIN}
+ORDER BY todos.id
+"""
+
+def _attach_checks(ts):
+    checks = _recurred_checks(t['id'] for t in ts if t['recurrence'])
+    for t in ts:
+        t['checked_at'] = checks.get(t['id'])
+    return ts
+
+@functools.lru_cache(maxsize=16)
+def _children_q(condition):
+    return f"SELECT todos.*, {_HAS_CHILDREN}, {_STATS_COLUMNS} FROM todos {_STATS_JOIN} WHERE parent_id IS ? AND ({condition}) ORDER BY id"
+
+@metrics.timed
+def todo_children(todo_id, filters=None, now=None):
+    condition, args = filter_condition(filters, now)
+    return _attach_checks(raw_select(_children_q(condition), (todo_id, *args), factory=_todo_row))
+
+@metrics.timed
+def todo_tree(filters=None, now=None):
+    flush_ui_state()
+    condition, args = filter_condition(filters, now)
+    loaded = _attach_checks(raw_select(_visible_tree_q(condition), args * 2, factory=_todo_row))
+    node_map = {t.id: t for t in loaded}
     res = []
-    all_todos = todos()
-    for t in all_todos:
-        t["children"] = []
-        if t['parent_id'] is None:
+    for t in loaded:
+        if t.parent_id is None:
             res.append(t)
-        else:
-            try:
-                node_map[t['parent_id']]['children'].append(t)
-            except KeyError:
-                pass
-        node_map[t['id']] = t
+        elif (parent := node_map.get(t.parent_id)) is not None and parent.children is not None:
+            parent.children.append(t)
     return res
 
+## Todo cache
+# Point reads (todo_by) go through an identity map of transformed rows plus
+# a bounded LRU of check histories. Writes through this module invalidate
+# the touched todos; writes from any other connection, including other
+# threads' and processes', show up as a change in PRAGMA data_version and
+# drop the whole cache. Callers get a shallow copy of the cached row, so
+# mutating it is fine, but the checked_at array is shared.
+CHECK_CACHE_SIZE = 256
+_CACHE_LOCK = threading.Lock()
+_TODO_CACHE = {}
+_CHECK_CACHE = OrderedDict()
+
+def clear_cache():
+    with _CACHE_LOCK:
+        _TODO_CACHE.clear()
+        _CHECK_CACHE.clear()
+
+def _invalidate(*todo_ids):
+    with _CACHE_LOCK:
+        for todo_id in todo_ids:
+            _TODO_CACHE.pop(todo_id, None)
+            _CHECK_CACHE.pop(todo_id, None)
+
+def _validate_cache():
+    version = conn().execute("PRAGMA data_version").fetchone()[0]
+    if getattr(_LOCAL, "data_version", None) != version:
+        _LOCAL.data_version = version
+        metrics.count("model.todo_cache.cleared")
+        clear_cache()
+
+@metrics.timed
 def todo_by(id):
-    try:
-        t = select("todos", "*", where={"id": id}, transform=_transform_todo)[0]
-        if t['recurrence']:
-            t['checked_at'] = _checks_of(t['id'])
-        return t
-    except IndexError:
-        pass
+    _validate_cache()
+    if (t := _TODO_CACHE.get(id)) is None:
+        metrics.count("model.todo_cache.miss")
+        try:
+            t = raw_select(_TODO_BY_Q, (id,), factory=_todo_row)[0]
+        except IndexError:
+            return None
+        with _CACHE_LOCK:
+            _TODO_CACHE[id] = t
+    else:
+        metrics.count("model.todo_cache.hit")
+    t = t.copy()
+    if t.recurrence:
+        t.checked_at = _checks_of(t.id)
+    return t
 
+@metrics.timed
 def todo_shred(todo_id):
-    todo = todo_by(id=todo_id)
-    assert todo, "No such TODO"
-
-    with CONN as cur:
+    "Delete a todo and everything under it for good, checks and all."
+    with conn() as cur:
         c = cur.cursor()
-        c.execute(*sql.deleteQ("todos", where={"id": todo_id}))
+        c.execute("BEGIN IMMEDIATE")
+        assert _subtree(c, todo_id), "No such TODO"
+        ids = _shred_subtree(c)
+    _forget_todos(ids)
+    return len(ids)
 
+@metrics.timed
 def todo_add(title, body=None, recurrence=None, parent_id=None):
-    with CONN as cur:
+    with conn() as cur:
         c = cur.cursor()
         ins = {"title": title, "body": body}
         if recurrence == "once":
@@ -148,24 +575,26 @@ def todo_add(title, body=None, recurrence=None, parent_id=None):
         c.execute(*sql.insertQ("todos", **ins))
         return todo_by(c.lastrowid)
 
-def todo_streak(todo):
+@metrics.timed
+def todo_streak(todo, now=None):
+    "Days are UTC, like last_check_day (and checks.created); so is `now`."
     if not todo['recurrence']:
         return None
-    checked = set(dt.date() for dt in (todo['checked_at'] or []))
-    checked_p = [
-        (day.date() in checked)
-        for day
-        in recurr.days_range(todo['created'], datetime.now())
-    ]
-    streak = list(itertools.takewhile(lambda t: t, reversed(checked_p)))
-    return len(streak)
+    if (last_day := todo.get('last_check_day')) is None:
+        return 0
+    today = (now or datetime.utcnow()).date()
+    if last_day < today - timedelta(days=1):
+        return 0
+    return todo['streak']
 
+@metrics.timed
 def todo_checked_p(todo):
     if todo['recurrence'] and todo['checked_at']:
-        should_recur = recurr.should_recur_p(todo['recurrence'], todo['checked_at'][-1])
+        should_recur = recurr.should_recur_p(todo['recurrence'], last_checked_at(todo))
         return todo['checked'] and todo['checked_at'] and not should_recur
     return todo['checked']
 
+@metrics.timed
 def todo_update(todo_id, check=None, title=None, body=None, recurrence=None, delete=None):
     todo = todo_by(id=todo_id)
     assert todo, "No such TODO"
@@ -185,50 +614,986 @@ def todo_update(todo_id, check=None, title=None, body=None, recurrence=None, del
         update['recurrence'] = recurrence
     if not update:
         return None
-    with CONN as cur:
+    with conn() as cur:
         c = cur.cursor()
         q, args = sql.updateQ("todos", **update, where={"id": todo_id})
         c.execute(q, args)
         if 'checked' in update:
             c.execute(*sql.insertQ('checks', todo_id=todo_id, checked=check))
+            c.execute(_STATS_BUMP_Q, (todo_id,))
+        if 'checked' in update or 'recurrence' in update:
+            _refresh_next_due(c, [todo_id])
+    _invalidate(todo_id)
     return todo_by(id=todo_id)
 
 
+## Streak/check aggregates
+# A check extends the streak if the previous one landed on the day before,
+# leaves it alone on the same day, and restarts it after a gap. Days are
+# taken from the check's own timestamp, same as checks.created.
+_NEXT_STREAK = """CASE
+  WHEN todo_stats.last_check_day = date('now') THEN todo_stats.streak
+  WHEN todo_stats.last_check_day = date('now', '-1 day') THEN todo_stats.streak + 1
+  ELSE 1 END"""
+
+_STATS_BUMP = f"""
+ON CONFLICT(todo_id) DO UPDATE SET
+  check_count = todo_stats.check_count + 1,
+  streak = {_NEXT_STREAK},
+  longest_streak = max(todo_stats.longest_streak, {_NEXT_STREAK}),
+  last_check_day = date('now')
+"""
+_STATS_COLS = "todo_stats (todo_id, check_count, streak, longest_streak, last_check_day)"
+_STATS_BUMP_Q = f"INSERT INTO {_STATS_COLS} VALUES (?, 1, 1, 1, date('now')) {_STATS_BUMP}"
+# `WHERE true` keeps sqlite from reading ON CONFLICT as a join constraint
+_STATS_BUMP_SUBTREE_Q = f"INSERT INTO {_STATS_COLS} SELECT id, 1, 1, 1, date('now') FROM temp.subtree WHERE true {_STATS_BUMP}"
+
+def _stats_rows(day_counts):
+    todo_id, count, streak, longest, last_day = None, 0, 0, 0, None
+    for tid, day, n in day_counts:
+        day = date.fromisoformat(day)
+        if tid == todo_id and day == last_day:
+            count += n
+            continue
+        if tid != todo_id:
+            if todo_id is not None:
+                yield (todo_id, count, streak, longest, last_day.isoformat())
+            todo_id, count, streak, longest = tid, 0, 1, 0
+        elif day - last_day == timedelta(days=1):
+            streak += 1
+        else:
+            streak = 1
+        count += n
+        longest = max(longest, streak)
+        last_day = day
+    if todo_id is not None:
+        yield (todo_id, count, streak, longest, last_day.isoformat())
+
+def _rebuild_stats(c):
+    c.execute("DELETE FROM todo_stats")
+    day_counts = c.connection.cursor().execute(
+        "SELECT todo_id, date(created) AS day, COUNT(*) FROM checks GROUP BY todo_id, day ORDER BY todo_id, day"
+    )
+    if _table_exists(c, "check_rollups"):
+        day_counts = heapq.merge(_rollup_day_counts(c), day_counts, key=lambda el: el[:2])
+    c.executemany(
+        "INSERT INTO todo_stats (todo_id, check_count, streak, longest_streak, last_check_day) VALUES (?, ?, ?, ?, ?)",
+        _stats_rows(day_counts)
+    )
+
+@metrics.timed
+def rebuild_stats():
+    """Recompute todo_stats from checks and rollups, logging every todo with
+    any as changed so cached responses and syncing clients pick it up."""
+    with conn() as cur:
+        c = cur.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        _rebuild_stats(c)
+        c.execute("UPDATE data_version SET version = version + 1")
+        c.execute("""INSERT OR REPLACE INTO changes (todo_id, version, op)
+SELECT todo_id, (SELECT version FROM data_version), 'upsert' FROM (
+  SELECT todo_id FROM checks UNION SELECT todo_id FROM check_rollups
+) WHERE todo_id IN (SELECT id FROM todos)""")
+    clear_cache()
+
+
+## Check rollups
+# compact_checks folds check rows older than some number of days into one
+# check_rollups row per todo: a bitmap of the days that had any check, bit i
+# of the blob being first_day + i, and how many rows went into it. Each
+# todo's latest check always stays a row, so due times are unaffected.
+# Readers put the rolled-up days, as midnight UTC epoch seconds, in front of
+# the remaining rows; stats count rolled rows like any others.
+_EPOCH_DAY = _EPOCH.toordinal()
+
+def _days_bitmap(days):
+    "Sorted date ordinals to (first ordinal, bitmap bytes)."
+    first = days[0]
+    bits = bytearray((days[-1] - first) // 8 + 1)
+    for day in days:
+        i = day - first
+        bits[i >> 3] |= 1 << (i & 7)
+    return first, bytes(bits)
+
+def _bitmap_days(first, bits):
+    return [first + (i << 3) + b for i, byte in enumerate(bits) if byte for b in range(8) if byte >> b & 1]
+
+def _table_exists(c, name):
+    return c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+_ROLLUPS_Q = "SELECT todo_id, first_day, days, check_count FROM check_rollups"
+_RECURRED_ROLLUPS_Q = f"{_ROLLUPS_Q} JOIN todos ON todos.id = check_rollups.todo_id WHERE todos.recurrence IS NOT NULL"
+
+def _rollups(c, todo_ids=None):
+    "(todo_id, epoch seconds of each rolled-up day) for `todo_ids`, or every recurring todo."
+    if todo_ids is None:
+        query, args = _RECURRED_ROLLUPS_Q, ()
+    else:
+        query, args = f"{_ROLLUPS_Q} WHERE todo_id IN ({', '.join('?' for _ in todo_ids)})", tuple(todo_ids)
+    with metrics.timer("sql", query):
+        rows = c.execute(query, args).fetchall()
+    for todo_id, first_day, days, _ in rows:
+        first = date.fromisoformat(first_day).toordinal()
+        yield todo_id, [(day - _EPOCH_DAY) * 86400 for day in _bitmap_days(first, days)]
+
+def _rollup_day_counts(c):
+    """check_rollups as (todo_id, day, count) rows like _rebuild_stats reads
+    from checks. Per-day counts aren't kept, so the whole rolled-up count
+    goes on the first day."""
+    for todo_id, first_day, days, count in c.connection.cursor().execute(f"{_ROLLUPS_Q} ORDER BY todo_id"):
+        for i, day in enumerate(_bitmap_days(date.fromisoformat(first_day).toordinal(), days)):
+            yield (todo_id, date.fromordinal(day).isoformat(), count if i == 0 else 0)
+
+_ROLLABLE = "todo_id = ? AND created < ? AND id < ?"
+
+# The rolled-up check deletes would each go through the checks change
+# trigger, one data_version bump and changes row per deleted check; a
+# 'compacting' row in meta, only ever set inside a batch's transaction,
+# turns that off, and each batch logs its todos once instead.
+_NOT_COMPACTING = "NOT EXISTS (SELECT 1 FROM meta WHERE name = 'compacting')"
+
+def _compact_batch(todo_ids, cutoff):
+    with conn() as cur:
+        c = cur.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        rolled = {}
+        latest_q = f"SELECT todo_id, MAX(id) FROM checks WHERE todo_id IN ({', '.join('?' for _ in todo_ids)}) GROUP BY todo_id"
+        for todo_id, latest in c.execute(latest_q, todo_ids).fetchall():
+            days = c.execute(
+                f"SELECT date(created) AS day, COUNT(*) FROM checks WHERE {_ROLLABLE} GROUP BY day",
+                (todo_id, cutoff, latest)
+            ).fetchall()
+            if days:
+                rolled[todo_id] = (latest, {date.fromisoformat(day).toordinal() for day, _ in days}, sum(n for _, n in days))
+        if not rolled:
+            return 0
+        total = sum(count for _, _, count in rolled.values())
+        existing = {
+            row[0]: row[1:]
+            for row in c.execute(f"{_ROLLUPS_Q} WHERE todo_id IN ({', '.join('?' for _ in rolled)})", tuple(rolled)).fetchall()
+        }
+        rows = []
+        for todo_id, (_, days, count) in rolled.items():
+            if (prev := existing.get(todo_id)) is not None:
+                days.update(_bitmap_days(date.fromisoformat(prev[0]).toordinal(), prev[1]))
+                count += prev[2]
+            first, bits = _days_bitmap(sorted(days))
+            rows.append((todo_id, date.fromordinal(first).isoformat(), bits, count))
+        c.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('compacting', NULL)")
+        c.executemany(
+            f"DELETE FROM checks WHERE {_ROLLABLE}",
+            [(todo_id, cutoff, latest) for todo_id, (latest, _, _) in rolled.items()]
+        )
+        c.execute("DELETE FROM meta WHERE name = 'compacting'")
+        c.executemany(
+            "INSERT OR REPLACE INTO check_rollups (todo_id, first_day, days, check_count) VALUES (?, ?, ?, ?)", rows
+        )
+        c.execute("UPDATE data_version SET version = version + 1")
+        c.executemany(
+            "INSERT OR REPLACE INTO changes (todo_id, version, op) SELECT ?, version, 'upsert' FROM data_version",
+            [(todo_id,) for todo_id in rolled]
+        )
+    _invalidate(*rolled)
+    return total
+
+@metrics.timed
+def compact_checks(older_than_days=90, batch=50, pause=0.02):
+    """Roll checks from before `older_than_days` days ago into check_rollups.
+    Goes `batch` todos at a time, each batch its own short transaction with
+    a `pause` after it, so other writers get the lock in between. Returns
+    how many check rows were rolled up."""
+    c = conn()
+    cutoff = c.execute("SELECT date('now', ?)", (f"-{int(older_than_days)} days",)).fetchone()[0]
+    todo_ids = [row[0] for row in c.execute(
+        "SELECT todo_id FROM checks GROUP BY todo_id HAVING MIN(created) < ? AND COUNT(*) > 1", (cutoff,)
+    ).fetchall()]
+    total = 0
+    for i in range(0, len(todo_ids), batch):
+        total += _compact_batch(todo_ids[i:i + batch], cutoff)
+        time.sleep(pause)
+    with conn() as cur:
+        cur.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('compacted_at', CURRENT_TIMESTAMP)")
+    return total
+
+@metrics.timed
+def compact_checks_if_due(older_than_days=90, every=timedelta(days=1)):
+    """compact_checks, unless it already ran (from anywhere) within `every`.
+    For running on app start. Returns the rows rolled up, or None if skipped."""
+    row = conn().execute("SELECT value FROM meta WHERE name = 'compacted_at'").fetchone()
+    if row is not None and datetime.fromisoformat(row[0]) > datetime.utcnow() - every:
+        return None
+    return compact_checks(older_than_days)
+
+
+## Subtree operations
+# Each walks the subtree under a todo once, with a recursive CTE, into the
+# temp table `subtree`, and then works on that set, all in one transaction.
+# UNION rather than UNION ALL so a parent_id cycle can't loop forever.
+_SUBTREE_WALK = """WITH RECURSIVE walk(id) AS (
+  {}
+  UNION
+  SELECT todos.id FROM todos JOIN walk ON todos.parent_id = walk.id
+)"""
+_SUBTREE_Q = f"{_SUBTREE_WALK.format('SELECT id FROM todos WHERE id = ?')} INSERT INTO temp.subtree (id) SELECT id FROM walk"
+_ORPHANS_Q = _SUBTREE_WALK.format(
+    "SELECT id FROM todos WHERE parent_id IS NOT NULL AND parent_id NOT IN (SELECT id FROM todos)"
+) + " INSERT INTO temp.subtree (id) SELECT id FROM walk"
+
+def _changes(c):
+    "Rows changed by the last statement; rowcount stays -1 for ones starting WITH."
+    return c.execute("SELECT changes()").fetchone()[0]
+
+def _subtree(c, todo_id, query=_SUBTREE_Q):
+    "Fill temp.subtree; returns how many todos are in it."
+    c.execute("CREATE TEMP TABLE IF NOT EXISTS subtree (id INTEGER PRIMARY KEY)")
+    c.execute("DELETE FROM temp.subtree")
+    c.execute(query, () if todo_id is None else (todo_id,))
+    return _changes(c)
+
+def _subtree_ids(c):
+    return [el[0] for el in c.execute("SELECT id FROM temp.subtree")]
+
+_DANGLING = ("checks", "check_rollups", "todo_stats", "ui_expand")
+
+def _shred_subtree(c):
+    ids = _subtree_ids(c)
+    for table in _DANGLING:
+        c.execute(f"DELETE FROM {table} WHERE todo_id IN temp.subtree")
+    c.execute("DELETE FROM todos WHERE id IN temp.subtree")
+    return ids
+
+def _forget_todos(ids):
+    with _UI_LOCK:
+        for todo_id in ids:
+            _UI_EXPAND.pop(todo_id, None)
+    _invalidate(*ids)
+
+@metrics.timed
+def subtree_set_deleted(todo_id, deleted=True):
+    """Mark a todo and all its descendants deleted (or not). Returns how many
+    actually changed."""
+    with conn() as cur:
+        c = cur.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        assert _subtree(c, todo_id), "No such TODO"
+        c.execute(
+            "UPDATE todos SET deleted = ? WHERE id IN temp.subtree AND IFNULL(deleted, 0) != ?",
+            (bool(deleted), bool(deleted))
+        )
+        changed = c.rowcount
+        ids = _subtree_ids(c)
+    _invalidate(*ids)
+    return changed
+
+@metrics.timed
+def subtree_set_checked(todo_id, checked=True, now=None):
+    """Check (or uncheck) a todo and its live descendants, recording a check
+    for each one whose state changes, the way todo_update does. A recurring
+    todo that has come due counts as unchecked. Returns how many changed."""
+    now = (now or datetime.now()).strftime("%Y-%m-%d %H:%M:%S")
+    with conn() as cur:
+        c = cur.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        assert _subtree(c, todo_id), "No such TODO"
+        changing = f"{_NOT_DELETED} AND {'NOT ' if checked else ''}{_CHECKED}"
+        c.execute(f"DELETE FROM temp.subtree WHERE id NOT IN (SELECT id FROM todos WHERE {changing})", (now,))
+        ids = _subtree_ids(c)
+        c.execute("UPDATE todos SET checked = ? WHERE id IN temp.subtree", (bool(checked),))
+        c.execute("INSERT INTO checks (todo_id, checked) SELECT id, ? FROM temp.subtree", (bool(checked),))
+        c.execute(_STATS_BUMP_SUBTREE_Q)
+        _set_next_due(c, "id IN temp.subtree")
+    _invalidate(*ids)
+    return len(ids)
+
+_MOVE_Q = f"""{_SUBTREE_WALK.format('SELECT id FROM todos WHERE id = ?')}
+UPDATE todos SET parent_id = ? WHERE id = ? AND NOT EXISTS (SELECT 1 FROM walk WHERE walk.id IS ?)"""
+
+@metrics.timed
+def todo_move(todo_id, parent_id):
+    """Re-parent a todo, and with it its whole subtree. parent_id=None makes
+    it top-level. Refuses to move a todo under one of its own descendants."""
+    with conn() as cur:
+        c = cur.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        if parent_id is not None:
+            assert c.execute("SELECT 1 FROM todos WHERE id = ?", (parent_id,)).fetchone(), "No such parent TODO"
+        c.execute(_MOVE_Q, (todo_id, parent_id, todo_id, parent_id))
+        assert _changes(c), "No such TODO, or moving it under itself"
+    _invalidate(todo_id)
+    return todo_by(todo_id)
+
+@metrics.timed
+def gc_orphans():
+    """Shred todos whose parent no longer exists, with their subtrees, then
+    drop any checks, rollups, stats and expand state still pointing at todos
+    that are gone. Returns the todos shredded and the leftover rows dropped
+    from each of those tables."""
+    with conn() as cur:
+        c = cur.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        _subtree(c, None, _ORPHANS_Q)
+        removed = {"todos": len(ids := _shred_subtree(c))}
+        for table in _DANGLING:
+            c.execute(f"DELETE FROM {table} WHERE todo_id NOT IN (SELECT id FROM todos)")
+            removed[table] = c.rowcount
+    _forget_todos(ids)
+    return removed
+
+
+## Bulk writes
+# Everything below runs in one transaction with one executemany per
+# statement shape. New ids are reserved up front so that nested children
+# can point at parents that haven't been inserted yet.
+_TODO_COLS = ("id", "parent_id", "title", "body", "recurrence", "checked", "deleted")
+
+@functools.lru_cache(maxsize=32)
+def _ids_in_q(n):
+    return f"SELECT id FROM todos WHERE id IN ({', '.join('?' for _ in range(n))})"
+
+def _existing_ids(c, ids):
+    ids = list(set(ids))
+    found = set()
+    for i in range(0, len(ids), _CHUNK):
+        chunk = ids[i:i + _CHUNK]
+        found.update(row[0] for row in c.execute(_ids_in_q(len(chunk)), tuple(chunk)))
+    return found
+
+def _next_todo_id(c):
+    return c.execute(
+        "SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'todos'), 0), COALESCE((SELECT MAX(id) FROM todos), 0)) + 1"
+    ).fetchone()[0]
+
+def _normalize_recurrence(recurrence):
+    if recurrence == "once":
+        return None
+    if recurrence is not None:
+        assert recurr.validate(recurrence), f"Invalid recurrence: {recurrence}"
+    return recurrence
+
+def _flatten(todos, parent_id, next_id, explicit):
+    "Rows for `todos` and their children; any given parent_ids go in `explicit`."
+    for t in todos:
+        todo_id = next(next_id)
+        if t.get('parent_id') is not None:
+            explicit.add(t['parent_id'])
+        yield (
+            todo_id, t.get('parent_id', parent_id), t['title'], t.get('body'),
+            _normalize_recurrence(t.get('recurrence')),
+            bool(t.get('checked', False)), bool(t.get('deleted', False))
+        )
+        yield from _flatten(t.get('children') or [], todo_id, next_id, explicit)
+
+@metrics.timed
+def bulk_add(todos, parent_id=None):
+    """Insert an iterable of todo dicts (title, body, recurrence, checked,
+    deleted, and optionally parent_id or nested children) under parent_id.
+    A todo's own parent_id must be an existing todo; nest new ones through
+    `children`, so a batch can't make a cycle. Returns the new ids in
+    insertion order."""
+    with conn() as cur:
+        c = cur.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        explicit = set()
+        rows = list(_flatten(todos, parent_id, itertools.count(_next_todo_id(c)), explicit))
+        if parent_id is not None:
+            explicit.add(parent_id)
+        missing = explicit - _existing_ids(c, explicit)
+        assert not missing, f"No such parent TODO(s): {sorted(missing)}"
+        c.executemany(sql.insertQ("todos", **dict.fromkeys(_TODO_COLS))[0], rows)
+    return [row[0] for row in rows]
+
+def _update_row(u):
+    row = {}
+    if u.get('delete') is not None:
+        row['deleted'] = u['delete']
+    if u.get('title') is not None:
+        row['title'] = u['title']
+    if u.get('body') is not None:
+        row['body'] = u['body']
+    if u.get('check') is not None:
+        row['checked'] = u['check']
+    if u.get('recurrence') is not None:
+        row['recurrence'] = _normalize_recurrence(u['recurrence'])
+    return row
+
+@metrics.timed
+def bulk_update(updates):
+    """Apply an iterable of dicts shaped like todo_update's keyword arguments
+    plus an `id`. Returns the number of todos touched."""
+    by_shape = defaultdict(list)
+    checks, due = [], []
+    for u in updates:
+        if not (row := _update_row(u)):
+            continue
+        by_shape[tuple(row.keys())].append(tuple(row.values()) + (u['id'],))
+        if 'checked' in row:
+            checks.append((u['id'], row['checked']))
+        if 'checked' in row or 'recurrence' in row:
+            due.append(u['id'])
+    ids = [args[-1] for rows in by_shape.values() for args in rows]
+    with conn() as cur:
+        c = cur.cursor()
+        missing = set(ids) - _existing_ids(c, ids)
+        assert not missing, f"No such TODO(s): {sorted(missing)}"
+        for keys, rows in by_shape.items():
+            c.executemany(sql.updateQ("todos", **dict.fromkeys(keys), where={"id": None})[0], rows)
+        c.executemany(sql.insertQ("checks", todo_id=None, checked=None)[0], checks)
+        c.executemany(_STATS_BUMP_Q, [(todo_id,) for todo_id, _ in checks])
+        _refresh_next_due(c, due)
+    _invalidate(*ids)
+    return len(ids)
+
+
+## Due times
+# todos.next_due_at is when a checked recurring todo comes due again: its
+# latest check plus the rule's period, in the same (UTC) terms as
+# checks.created. NULL when it doesn't recur or was never checked. Kept
+# current on every check and recurrence change so filters can use it.
+_NEXT_DUE = "(SELECT datetime(MAX(checks.created), ?) FROM checks WHERE checks.todo_id = todos.id)"
+
+def _set_next_due(c, condition, args=()):
+    "Recompute next_due_at for the todos matching `condition`, one statement per distinct rule."
+    c.execute(
+        f"UPDATE todos SET next_due_at = NULL WHERE ({condition}) AND recurrence IS NULL AND next_due_at IS NOT NULL", args
+    )
+    for (rec,) in c.execute(f"SELECT DISTINCT recurrence FROM todos WHERE ({condition}) AND recurrence IS NOT NULL", args).fetchall():
+        period = f"+{rule.hours} hours" if (rule := recurr.from_string(rec)) else None
+        c.execute(
+            f"UPDATE todos SET next_due_at = {_NEXT_DUE} WHERE ({condition}) AND recurrence = ? AND next_due_at IS NOT {_NEXT_DUE}",
+            (period, *args, rec, period)
+        )
+
+def _refresh_next_due(c, todo_ids=None):
+    "Recompute next_due_at for `todo_ids`, or for every todo."
+    if todo_ids is None:
+        return _set_next_due(c, "1")
+    todo_ids = list(todo_ids)
+    for i in range(0, len(todo_ids), _CHUNK):
+        chunk = todo_ids[i:i + _CHUNK]
+        _set_next_due(c, f"id IN ({', '.join('?' for _ in chunk)})", tuple(chunk))
+
+def upcoming_due(now=None):
+    "The soonest next_due_at after `now` among checked, live todos, or None."
+    now = (now or datetime.now()).strftime("%Y-%m-%d %H:%M:%S")
+    row = conn().execute(
+        "SELECT MIN(next_due_at) FROM todos WHERE next_due_at > ? AND checked AND NOT IFNULL(deleted, 0)", (now,)
+    ).fetchone()
+    return None if row[0] is None else datetime.fromisoformat(row[0])
+
+
+## Search
+# todos_fts is an external-content FTS5 index over todos' title and body,
+# kept in step by triggers. search() ranks hits with bm25, weighting titles
+# over bodies, and returns each with the chain of ancestors from its root
+# down to its parent so the UI can open the way to it. Where sqlite was
+# built without FTS5 (some python-for-android recipes), there's no index
+# and search() falls back to LIKE over the same columns, ranked by how many
+# words hit the title (weighted 4) and the body.
+_FTS_TRIGGERS = [
+    """CREATE TRIGGER IF NOT EXISTS todos_fts_insert AFTER INSERT ON todos BEGIN
+  INSERT INTO todos_fts (rowid, title, body) VALUES (NEW.id, NEW.title, NEW.body);
+END""",
+    """CREATE TRIGGER IF NOT EXISTS todos_fts_delete AFTER DELETE ON todos BEGIN
+  INSERT INTO todos_fts (todos_fts, rowid, title, body) VALUES ('delete', OLD.id, OLD.title, OLD.body);
+END""",
+    """CREATE TRIGGER IF NOT EXISTS todos_fts_update AFTER UPDATE OF title, body ON todos BEGIN
+  INSERT INTO todos_fts (todos_fts, rowid, title, body) VALUES ('delete', OLD.id, OLD.title, OLD.body);
+  INSERT INTO todos_fts (rowid, title, body) VALUES (NEW.id, NEW.title, NEW.body);
+END"""
+]
+
+_SEARCH_Q = f"""
+WITH hits(id, rank) AS (
+  SELECT rowid, bm25(todos_fts, 4.0, 1.0) FROM todos_fts WHERE todos_fts MATCH ?
+)
+SELECT todos.*, {_STATS_COLUMNS}, hits.rank AS rank
+FROM hits JOIN todos ON todos.id = hits.id {_STATS_JOIN}
+WHERE {{}}
+ORDER BY hits.rank LIMIT ?
+"""
+
+@functools.lru_cache(maxsize=32)
+def _like_search_q(n, condition):
+    matches = "todos.title LIKE words.p ESCAPE '\\'", "IFNULL(todos.body, '') LIKE words.p ESCAPE '\\'"
+    return f"""
+WITH words(p) AS (VALUES {', '.join('(?)' for _ in range(n))})
+SELECT todos.*, {_STATS_COLUMNS},
+       -(SELECT SUM(({matches[0]}) * 4 + ({matches[1]})) FROM words) AS rank
+FROM todos {_STATS_JOIN}
+WHERE ({condition}) AND NOT EXISTS (SELECT 1 FROM words WHERE NOT ({matches[0]} OR {matches[1]}))
+ORDER BY rank, todos.id LIMIT ?
+"""
+
+def _like_pattern(word):
+    return "%{}%".format(word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_"))
+
+def _fts5_available(c):
+    return any(row[0] == "ENABLE_FTS5" for row in c.execute("PRAGMA compile_options"))
+
+def _create_fts(c):
+    if not _fts5_available(c):
+        return
+    c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS todos_fts USING fts5(title, body, content='todos', content_rowid='id', prefix='2 3')")
+    for trigger in _FTS_TRIGGERS:
+        c.execute(trigger)
+    c.execute("INSERT INTO todos_fts (todos_fts) VALUES ('rebuild')")
+
+@functools.lru_cache(maxsize=32)
+def _ancestors_q(n):
+    # UNION over (hit, id), like _SUBTREE_WALK, so a parent_id cycle can't
+    # loop forever; search() puts each chain in order from the parent links.
+    return f"""
+WITH RECURSIVE up(hit, id) AS (
+  SELECT id, parent_id FROM todos WHERE id IN ({', '.join('?' for _ in range(n))}) AND parent_id IS NOT NULL
+  UNION
+  SELECT up.hit, todos.parent_id FROM up JOIN todos ON todos.id = up.id
+  WHERE todos.parent_id IS NOT NULL
+)
+SELECT up.hit, todos.id, todos.title, todos.parent_id FROM up JOIN todos ON todos.id = up.id
+"""
+
+def _ancestor_path(todo, links):
+    "Root-first {id, title} of `todo`'s ancestors, from {id: (title, parent_id)}."
+    path, seen, todo_id = [], {todo.id}, todo.parent_id
+    while todo_id in links and todo_id not in seen:
+        seen.add(todo_id)
+        title, parent_id = links[todo_id]
+        path.append({"id": todo_id, "title": title})
+        todo_id = parent_id
+    path.reverse()
+    return path
+
+def _fts_query(text):
+    """Free text to an FTS5 query: every word must match, as a prefix once
+    it's at least two characters (a lone letter would match nearly
+    everything and then all of it has to be ranked)."""
+    return " ".join(
+        '"{}"{}'.format(word.replace('"', '""'), "*" if len(word) > 1 else "")
+        for word in text.split()
+    )
+
+def _search_row(cursor, row):
+    return _todo_row(cursor, row), row[-1]
+
+@metrics.timed
+def search(query, limit=20, deleted=False):
+    """Todos matching `query`, best first, as dicts with the `todo`, its bm25
+    `rank` (lower is better) and `path`, the {id, title} of each ancestor
+    from the root down. Pass deleted=None to include deleted todos too."""
+    if not (match := _fts_query(query)):
+        return []
+    condition = "1" if deleted is None else ("IFNULL(todos.deleted, 0)" if deleted else _NOT_DELETED)
+    if _table_exists(conn(), "todos_fts"):
+        hits = raw_select(_SEARCH_Q.format(condition), (match, limit), factory=_search_row)
+    else:
+        words = query.split()
+        hits = raw_select(_like_search_q(len(words), condition), (*map(_like_pattern, words), limit), factory=_search_row)
+    links = defaultdict(dict)
+    if hits:
+        query = _ancestors_q(len(hits))
+        with metrics.timer("sql", query):
+            for hit, todo_id, title, parent_id in conn().execute(query, tuple(t.id for t, _ in hits)):
+                links[hit][todo_id] = (title, parent_id)
+    _attach_checks([t for t, _ in hits])
+    return [{"todo": t, "rank": rank, "path": _ancestor_path(t, links[t.id])} for t, rank in hits]
+
+
+## Change log
+# Every write to a todo (or its checks) bumps data_version and records the
+# todo in `changes` under the new version, one row per todo, so syncing
+# clients only need the rows that changed since the version they last saw.
+# Shredded todos stay behind as 'delete' tombstones. The todos update
+# trigger also keeps todos.updated current; it doesn't re-fire itself
+# since recursive triggers are off.
+def _change_trigger(table, op, todo_id, change, extra="", when=None):
+    return f"""CREATE TRIGGER IF NOT EXISTS {table}_{op.lower()}_change AFTER {op} ON {table}{f" WHEN {when}" if when else ""} BEGIN
+  {extra}
+  UPDATE data_version SET version = version + 1;
+  INSERT OR REPLACE INTO changes (todo_id, version, op) SELECT {todo_id}, version, '{change}' FROM data_version;
+END"""
+
+_CHANGES_Q = f"""
+SELECT changes.version AS change_version, changes.op AS change_op, changes.todo_id AS change_todo_id,
+       todos.*, {_STATS_COLUMNS}
+FROM changes LEFT JOIN todos ON todos.id = changes.todo_id {_STATS_JOIN}
+WHERE changes.version > ?
+ORDER BY changes.version
+LIMIT ?
+"""
+
+@metrics.timed
+def changes_since(since=0, limit=500):
+    """Todos written after data version `since`, oldest change first, plus
+    the ids of todos shredded since then. Pass the returned version back in
+    to continue; `more` says whether another call would return anything."""
+    with conn() as cur:
+        c = cur.cursor()
+        c.execute("BEGIN")
+        c.execute(_CHANGES_Q, (since, limit))
+        columns = [el[0] for el in c.description]
+        rows = [dict(zip(columns, vals)) for vals in c.fetchall()]
+        current = c.execute("SELECT version FROM data_version").fetchone()[0]
+    more = len(rows) == limit
+    version = rows[-1]['change_version'] if more else current
+    updated, deleted = [], []
+    for row in rows:
+        if row.pop('change_op') == 'delete' or row['id'] is None:
+            deleted.append(row['change_todo_id'])
+        else:
+            updated.append(row)
+    for row in updated:
+        del row['change_version'], row['change_todo_id']
+        _transform_todo(row)
+    return {
+        "version": version,
+        "more": more,
+        "todos": _attach_checks(updated),
+        "deleted": deleted
+    }
+
+
+## Migrations
+# Each entry is one schema version; its steps are SQL strings or callables
+# taking a cursor, and run in a single transaction together with the
+# version bump. Only ever append to this list.
+MIGRATIONS = [
+    [
+        sql.createQ("todo_stats", [
+            "todo_id INTEGER PRIMARY KEY NOT NULL",
+            "check_count INTEGER DEFAULT 0 NOT NULL",
+            "streak INTEGER DEFAULT 0 NOT NULL",
+            "longest_streak INTEGER DEFAULT 0 NOT NULL",
+            "last_check_day DATE",
+            "FOREIGN KEY(todo_id) REFERENCES todos(id) ON DELETE CASCADE"
+        ]),
+        _rebuild_stats
+    ],
+    [
+        "CREATE INDEX IF NOT EXISTS checks_todo_id_created ON checks(todo_id, created)",
+        "CREATE INDEX IF NOT EXISTS todos_parent_id ON todos(parent_id)",
+        "CREATE INDEX IF NOT EXISTS todos_recurrence ON todos(recurrence)"
+    ],
+    [
+        "DELETE FROM ui_expand WHERE rowid NOT IN (SELECT MIN(rowid) FROM ui_expand GROUP BY todo_id)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ui_expand_todo_id ON ui_expand(todo_id)"
+    ],
+    [
+        sql.createQ("data_version", [
+            "id INTEGER PRIMARY KEY CHECK (id = 1)",
+            "version INTEGER NOT NULL"
+        ]),
+        "INSERT OR IGNORE INTO data_version (id, version) VALUES (1, 0)",
+        *(
+            f"CREATE TRIGGER IF NOT EXISTS {table}_{op.lower()}_version AFTER {op} ON {table} "
+            "BEGIN UPDATE data_version SET version = version + 1; END"
+            for table in ("todos", "checks")
+            for op in ("INSERT", "UPDATE", "DELETE")
+        )
+    ],
+    [
+        sql.createQ("changes", [
+            "todo_id INTEGER PRIMARY KEY NOT NULL",
+            "version INTEGER NOT NULL",
+            "op TEXT NOT NULL"
+        ]),
+        "CREATE INDEX IF NOT EXISTS changes_version ON changes(version)",
+        "UPDATE data_version SET version = version + 1",
+        "INSERT OR REPLACE INTO changes (todo_id, version, op) SELECT id, (SELECT version FROM data_version), 'upsert' FROM todos",
+        *(
+            f"DROP TRIGGER IF EXISTS {table}_{op.lower()}_version"
+            for table in ("todos", "checks")
+            for op in ("INSERT", "UPDATE", "DELETE")
+        ),
+        _change_trigger("todos", "INSERT", "NEW.id", "upsert"),
+        _change_trigger(
+            "todos", "UPDATE", "NEW.id", "upsert",
+            "UPDATE todos SET updated = CURRENT_TIMESTAMP WHERE id = NEW.id AND NEW.updated IS OLD.updated;"
+        ),
+        _change_trigger("todos", "DELETE", "OLD.id", "delete"),
+        _change_trigger("checks", "INSERT", "NEW.todo_id", "upsert"),
+        _change_trigger("checks", "UPDATE", "NEW.todo_id", "upsert"),
+        _change_trigger("checks", "DELETE", "OLD.todo_id", "upsert")
+    ],
+    [
+        "ALTER TABLE todos ADD COLUMN next_due_at DATETIME",
+        _refresh_next_due,
+        # Same leading column as todos_parent_id, which it replaces, so the
+        # filter columns are checked in the index before rows are read.
+        "CREATE INDEX IF NOT EXISTS todos_filter ON todos(parent_id, deleted, checked, next_due_at)",
+        "DROP INDEX IF EXISTS todos_parent_id"
+    ],
+    [
+        _create_fts
+    ],
+    [
+        sql.createQ("check_rollups", [
+            "todo_id INTEGER PRIMARY KEY NOT NULL",
+            "first_day DATE NOT NULL",
+            "days BLOB NOT NULL",
+            "check_count INTEGER NOT NULL",
+            "FOREIGN KEY(todo_id) REFERENCES todos(id) ON DELETE CASCADE"
+        ])
+    ],
+    [
+        sql.createQ("meta", ["name TEXT PRIMARY KEY NOT NULL", "value TEXT"])
+    ],
+    [
+        "DROP TRIGGER IF EXISTS checks_delete_change",
+        _change_trigger("checks", "DELETE", "OLD.todo_id", "upsert", when=_NOT_COMPACTING)
+    ]
+]
+
+def data_version():
+    """Bumped by triggers on every write to todos or checks, from any
+    connection or process. Cheap enough to poll."""
+    return conn().execute("SELECT version FROM data_version").fetchone()[0]
+
+def schema_version():
+    with conn() as cur:
+        cur.execute(sql.createQ("schema_version", ["version INTEGER NOT NULL"]))
+        if (row := cur.execute("SELECT version FROM schema_version").fetchone()) is None:
+            cur.execute(*sql.insertQ("schema_version", version=0))
+            return 0
+        return row[0]
+
+def migrate():
+    current = schema_version()
+    for version, steps in enumerate(MIGRATIONS[current:], start=current + 1):
+        with conn() as cur:
+            c = cur.cursor()
+            c.execute("BEGIN")
+            for step in steps:
+                if callable(step):
+                    step(c)
+                else:
+                    c.execute(step)
+            c.execute(*sql.updateQ("schema_version", version=version))
+    return len(MIGRATIONS)
+
+
 ## UI state
+# Expand/collapse and filter changes are write-behind: they land in memory
+# immediately (and reads see them), and flush_ui_state writes whatever is
+# pending in one transaction. The app calls it on a debounce timer and on
+# pause/stop; only the last state per todo/filter ever reaches the disk.
+_UI_LOCK = threading.Lock()
+_UI_EXPAND = {}
+_UI_FILTERS = {}
+_UI_FILTERS_STORED = {}
+
+@metrics.timed
 def todo_collapse(todo_id):
-    with CONN as cur:
-        c = cur.cursor()
-        c.execute(*sql.deleteQ("ui_expand", where={"todo_id": todo_id}))
+    with _UI_LOCK:
+        _UI_EXPAND[todo_id] = False
 
+@metrics.timed
 def todo_expand(todo_id):
-    with CONN as cur:
-        c = cur.cursor()
-        c.execute(*sql.insertQ("ui_expand", todo_id=todo_id))
+    with _UI_LOCK:
+        _UI_EXPAND[todo_id] = True
 
+@metrics.timed
 def expanded_todos():
-    return {el['todo_id'] for el in select("ui_expand", "todo_id")}
+    res = {el['todo_id'] for el in select("ui_expand", "todo_id")}
+    with _UI_LOCK:
+        for todo_id, expanded in _UI_EXPAND.items():
+            if expanded:
+                res.add(todo_id)
+            else:
+                res.discard(todo_id)
+    return res
 
+@metrics.timed
 def ui_filter_update(filter_map):
-    with CONN as cur:
-        c = cur.cursor()
-        for name, checked in filter_map.items():
-            c.execute(*sql.updateQ("ui_filters", checked=checked, where={"name": name}))
+    with _UI_LOCK:
+        _UI_FILTERS.update(filter_map)
 
+@metrics.timed
 def ui_filters():
-    return {el['name']: bool(el['checked']) for el in  select("ui_filters", "*")}
+    if not _UI_FILTERS_STORED:
+        _UI_FILTERS_STORED.update((el['name'], bool(el['checked'])) for el in select("ui_filters", "*"))
+    res = dict(_UI_FILTERS_STORED)
+    with _UI_LOCK:
+        res.update((name, bool(checked)) for name, checked in _UI_FILTERS.items())
+    return res
+
+@metrics.timed
+def flush_ui_state():
+    with _UI_LOCK:
+        expand, filters = dict(_UI_EXPAND), dict(_UI_FILTERS)
+        _UI_EXPAND.clear()
+        _UI_FILTERS.clear()
+    if not (expand or filters):
+        return
+    metrics.count("model.ui_flushes")
+    metrics.count("model.ui_flush_rows", len(expand) + len(filters))
+    try:
+        with conn() as cur:
+            c = cur.cursor()
+            c.executemany(
+                sql.insert_ignoreQ("ui_expand", todo_id=None)[0],
+                [(todo_id,) for todo_id, expanded in expand.items() if expanded]
+            )
+            c.executemany(
+                sql.deleteQ("ui_expand", where={"todo_id": None})[0],
+                [(todo_id,) for todo_id, expanded in expand.items() if not expanded]
+            )
+            c.executemany(
+                sql.updateQ("ui_filters", checked=None, where={"name": None})[0],
+                [(checked, name) for name, checked in filters.items()]
+            )
+    except BaseException:
+        # Put it back for the next flush, behind anything that changed since.
+        with _UI_LOCK:
+            for todo_id, expanded in expand.items():
+                _UI_EXPAND.setdefault(todo_id, expanded)
+            for name, checked in filters.items():
+                _UI_FILTERS.setdefault(name, checked)
+        raise
+    if _UI_FILTERS_STORED:
+        _UI_FILTERS_STORED.update((name, bool(checked)) for name, checked in filters.items())
+
 
 
+## Backup and export
+# backup() copies the live file through sqlite's online backup API a few
+# pages per step, sleeping in between so other connections keep writing; a
+# write mid-copy just makes sqlite restart it. export_rows/import_rows
+# stream the tables as plain records, one row at a time from a single read
+# snapshot, so memory stays flat whatever the size of the database. Import
+# loads with the todos/checks triggers dropped, then rebuilds the search
+# index and logs every todo as changed in one go, the way migrations
+# backfill; the triggers come back in the same transaction.
+EXPORT_FORMAT = "todotree"
+EXPORT_TABLES = ("todos", "checks", "check_rollups", "todo_stats", "ui_expand", "ui_filters", "data_version")
+_BLOB_COLUMNS = {"check_rollups": ("days",)}
+
+class _BackupStarved(Exception):
+    pass
+
+@metrics.timed
+def backup(path, pages=256, sleep=0.005, progress=None, max_restarts=3):
+    """Write a consistent copy of the database to `path`, `pages` pages per
+    step. `progress(status, remaining, total)` is called after every step.
+    If writes keep restarting the copy, the rest goes in a single step, which
+    under WAL still doesn't block writers. Nothing appears at `path` until
+    the copy is complete."""
+    flush_ui_state()
+    partial = f"{path}.partial"
+    restarts, last = 0, None
+    def _step(status, remaining, total):
+        nonlocal restarts, last
+        if last is not None and remaining > last:
+            restarts += 1
+            if restarts > max_restarts:
+                raise _BackupStarved()
+        last = remaining
+        if progress is not None:
+            progress(status, remaining, total)
+    try:
+        with closing(connect(read_only=True)) as src, closing(sqlite3.connect(partial)) as dest:
+            try:
+                src.backup(dest, pages=pages, progress=_step, sleep=sleep)
+            except _BackupStarved:
+                src.backup(dest, pages=-1)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.replace(partial, path)
+
+def _export_row(table, columns, vals):
+    row = dict(zip(columns, vals))
+    for col in _BLOB_COLUMNS.get(table, ()):
+        row[col] = row[col].hex()
+    return {"table": table, "row": row}
+
+@metrics.timed
+def export_rows():
+    """A header record, then {"table": ..., "row": {...}} for every row of
+    EXPORT_TABLES, all from one snapshot. The inverse of import_rows."""
+    flush_ui_state()
+    c = connect(read_only=True)
+    try:
+        c.execute("BEGIN")
+        yield {"format": EXPORT_FORMAT, "schema_version": c.execute("SELECT version FROM schema_version").fetchone()[0]}
+        for table in EXPORT_TABLES:
+            if not _table_exists(c, table):
+                continue
+            rows = c.execute(f"SELECT * FROM {table} ORDER BY rowid")
+            columns = [el[0] for el in rows.description]
+            for vals in rows:
+                yield _export_row(table, columns, vals)
+    finally:
+        c.close()
+
+def _import_values(table, columns, rows, counts):
+    blobs = [i for i, col in enumerate(columns) if col in _BLOB_COLUMNS.get(table, ())]
+    for row in rows:
+        vals = [row["row"][col] for col in columns]
+        for i in blobs:
+            vals[i] = bytes.fromhex(vals[i])
+        counts[table] += 1
+        yield vals
+
+@metrics.timed
+def import_rows(records):
+    """Load records from export_rows (an iterable, consumed lazily) into a
+    database with no todos, keeping ids. Returns row counts per table."""
+    records = iter(records)
+    header = next(records, None)
+    assert header and header.get("format") == EXPORT_FORMAT, "Not a todotree export"
+    assert header["schema_version"] <= len(MIGRATIONS), "Export is from a newer schema"
+    counts = defaultdict(int)
+    with conn() as cur:
+        c = cur.cursor()
+        c.execute("BEGIN IMMEDIATE")
+        assert c.execute("SELECT 1 FROM todos LIMIT 1").fetchone() is None, "Can only import into an empty database"
+        triggers = c.execute("SELECT name, sql FROM sqlite_master WHERE type = 'trigger' AND tbl_name IN ('todos', 'checks')").fetchall()
+        for name, _ in triggers:
+            c.execute(f"DROP TRIGGER {name}")
+        for table, rows in itertools.groupby(records, operator.itemgetter("table")):
+            assert table in EXPORT_TABLES, f"Unknown table {table!r}"
+            first = next(rows)
+            columns = list(first["row"])
+            assert set(columns) <= set(table_columns(table)), f"Unknown columns in {table}"
+            c.executemany(
+                f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})",
+                _import_values(table, columns, itertools.chain([first], rows), counts)
+            )
+        # Exports from before next_due_at existed leave it NULL; the guard in
+        # there means current ones aren't touched (nor their `updated`).
+        _refresh_next_due(c)
+        for _, trigger in triggers:
+            c.execute(trigger)
+        if _table_exists(c, "todos_fts"):
+            c.execute("INSERT INTO todos_fts (todos_fts) VALUES ('rebuild')")
+        c.execute("UPDATE data_version SET version = version + 1")
+        c.execute("INSERT OR REPLACE INTO changes (todo_id, version, op) SELECT id, (SELECT version FROM data_version), 'upsert' FROM todos")
+        if "todo_stats" not in counts:
+            _rebuild_stats(c)
+    clear_cache()
+    with _UI_LOCK:
+        _UI_EXPAND.clear()
+        _UI_FILTERS.clear()
+    _UI_FILTERS_STORED.clear()
+    return dict(counts)
+
 def testing_todos():
-    todo_add("Finish first cut of TodoTree", "This means having a 'good enough' app running no your phone that you can use to plan other stuff in your life. It doesn't mean 'never do any more work on it'.")
-    todo_add("Finish first cut of Dumbfeed", "This means having a 'good enough' app running no your phone that you can use to read/listen to/keep running locally a bunch of your blogs. Including WordPress, substack, possibly Medium?, most generic XML feeds, and your literal blog. It doesn't mean 'never do any more work on it'.")
-    todo_add("Have basic model runing", None, parent_id=1)
-    todo_add("Be able to check things off", None, parent_id=1)
-    todo_add("Check _this_ off", None, parent_id=4)
-    tid = todo_add("Be able to add new TODOs", None, parent_id=1)
-    todo_add("Add the rest of the TODOs for this project", None, parent_id=tid['id'])
-    todo_add("Be able to edit existing TODOs", None, parent_id=1)
-    todo_add("Stylin'", None, parent_id=1)
-    todo_add("Be able to do cool things with dailies", None, parent_id=1)
-    todo_add("Exercise", recurrence="daily")
-    todo_add("Social", recurrence="daily at 11:00")
-    todo_add("Job Search", recurrence="daily")
+    bulk_add([
+        {"title": "Finish first cut of TodoTree", "body": "This means having a 'good enough' app running no your phone that you can use to plan other stuff in your life. It doesn't mean 'never do any more work on it'.", "children": [
+            {"title": "Have basic model runing"},
+            {"title": "Be able to check things off", "children": [
+                {"title": "Check _this_ off"}
+            ]},
+            {"title": "Be able to add new TODOs", "children": [
+                {"title": "Add the rest of the TODOs for this project"}
+            ]},
+            {"title": "Be able to edit existing TODOs"},
+            {"title": "Stylin'"},
+            {"title": "Be able to do cool things with dailies"}
+        ]},
+        {"title": "Finish first cut of Dumbfeed", "body": "This means having a 'good enough' app running no your phone that you can use to read/listen to/keep running locally a bunch of your blogs. Including WordPress, substack, possibly Medium?, most generic XML feeds, and your literal blog. It doesn't mean 'never do any more work on it'."},
+        {"title": "Exercise", "recurrence": "daily"},
+        {"title": "Social", "recurrence": "daily at 11:00"},
+        {"title": "Job Search", "recurrence": "daily"}
+    ])
@@ -1,6 +1,14 @@
 import datetime
+import functools
 import re
 
+import metrics
+
+
+_DAILY = re.compile(r"^daily(?: at (\d?\d:\d\d))?")
+_PERIODIC = re.compile(r"^(weekly|monthly|annually)(?: on (\S+)(?: at (\d?\d:\d\d))?)?")
+_PERIOD_DAYS = {"daily": 1, "weekly": 7, "monthly": 30, "annually": 365}
+
 
 def days_range(start_date, end_date):
     delta = end_date - start_date
@@ -9,19 +17,61 @@ def days_range(start_date, end_date):
 def delta_hours(delta):
     return (delta.total_seconds() / 60) / 60
 
+
+class Rule:
+    """A parsed recurrence string. Instances are shared between every todo
+    with the same recurrence, so treat them as immutable. Supports the
+    `rule['recurs']`-style access the old dict representation had."""
+    __slots__ = ("recurs", "on", "at", "days", "hours", "period")
+
+    def __init__(self, recurs, on=None, at=None):
+        self.recurs = recurs
+        self.on = on
+        self.at = at
+        self.days = _PERIOD_DAYS[recurs]
+        # A little slack so that checking something slightly earlier than
+        # yesterday still counts as a new period.
+        self.hours = (self.days * 24) - int(self.days * 0.1)
+        self.period = datetime.timedelta(hours=self.hours)
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __eq__(self, other):
+        return isinstance(other, Rule) and (self.recurs, self.on, self.at) == (other.recurs, other.on, other.at)
+
+    def __hash__(self):
+        return hash((self.recurs, self.on, self.at))
+
+    def __repr__(self):
+        return f"Rule({to_string(self)!r})"
+
+    def next_due(self, last_checked):
+        return last_checked + self.period
+
+
+@functools.lru_cache(maxsize=256)
 def from_string(string):
     string = string.strip().lower()
     if string.startswith("daily"):
-        if at := re.match("^daily(?: at (\d?\d:\d\d))?", string).group(1):
-            return {"recurs": "daily", "at": datetime.time.fromisoformat(at.strip())}
-        return {"recurs": "daily"}
-    if match := re.match("^(weekly|monthly|annually)(?: on (\S+)(?: at (\d?\d:\d\d))?)?", string):
-        res = {"recurs": match.group(1)}
+        if at := _DAILY.match(string).group(1):
+            return Rule("daily", at=datetime.time.fromisoformat(at.strip()))
+        return Rule("daily")
+    if match := _PERIODIC.match(string):
+        on, at = None, None
         if on := match.group(2):
-            res["on"] = on.strip()
+            on = on.strip()
             if at := match.group(3):
-                res["at"] = datetime.time.fromisoformat(at.strip())
-        return res
+                at = datetime.time.fromisoformat(at.strip())
+        return Rule(match.group(1), on=on, at=at)
 
 def validate(string):
     return bool(from_string(string))
@@ -32,24 +82,8 @@ def to_string(rec):
     r = rec['recurs']
     return " ".join(el for el in [r, on, at] if el is not None)
 
+@metrics.timed
 def should_recur_p(rec, last_checked, now=None):
     if now is None:
         now = datetime.datetime.now()
-    delta = now - last_checked
-    if rec['recurs'] == "daily":
-        days = 1
-    elif rec['recurs'] == "weekly":
-        days = 7
-    elif rec['recurs'] == "monthly":
-        days = 30
-    elif rec['recurs'] == "annually":
-        days = 365
-
-    hours = (days * 24) - int(days * 0.1)
-
-    day_check = (delta.days >= days) or (delta_hours(delta) >= hours)
-
-    if at := rec.get('at'):
-        return day_check or (delta.days == days and now.hour >= rec['at'].hour)
-
-    return day_check
+    return now >= rec.next_due(last_checked)
@@ -1,6 +1,58 @@
+import asyncio
+import datetime
+import json
+from array import array
+from collections import OrderedDict
+
 import tornado
 
+import metrics
 import model
+import recurrence
+from async_model import AsyncModel
+
+DB = AsyncModel()
+
+
+def _jsonable(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, recurrence.Rule):
+        return recurrence.to_string(obj)
+    if isinstance(obj, model.Todo):
+        return dict(obj)
+    if isinstance(obj, array):
+        return [model.from_epoch(n).isoformat() for n in obj]
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+def to_json(data):
+    return json.dumps(data, default=_jsonable)
+
+
+class ResponseCache:
+    """Serialized response bodies keyed by request URI, each tagged with the
+    model.data_version it was built from. Anything from an older version is
+    a miss. Bounded both in entries and in the size of a single body."""
+    def __init__(self, max_entries=32, max_body_bytes=4 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_body_bytes = max_body_bytes
+        self.entries = OrderedDict()
+
+    def get(self, key, version):
+        if (entry := self.entries.get(key)) is None or entry[0] != version:
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, version, body):
+        if len(body) > self.max_body_bytes:
+            return
+        self.entries[key] = (version, body)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+RESPONSES = ResponseCache()
 
 
 class JSONHandler(tornado.web.RequestHandler):
@@ -10,7 +62,12 @@ class JSONHandler(tornado.web.RequestHandler):
     def json(self, data, status=None):
         if status is not None:
             self.set_status(status)
-        self.write(json.dumps(data))
+        self.write(to_json(data))
+
+class TrapCard(JSONHandler):
+    def prepare(self):
+        self.json({"status": "error", "message": "Not found"}, status=404)
+        self.finish()
 
 class HealthHandler(JSONHandler):
     def get(self):
@@ -20,22 +77,128 @@ class HealthHandler(JSONHandler):
             res["value"] = val
         self.json(res)
 
+def _bool_arg(val):
+    if val is None:
+        return None
+    if val.lower() in ("1", "true", "yes"):
+        return True
+    if val.lower() in ("0", "false", "no"):
+        return False
+    raise ValueError(f"Expected a boolean, got {val!r}")
+
+def _int_arg(val):
+    return None if val is None else int(val)
+
 class TodoHandler(JSONHandler):
+    """Streams todos as newline-delimited JSON, one todo per line, flushing
+    after every page. Supports ?after_id=&limit= keyset pagination and
+    ?parent_id= (empty or "null" for top-level), ?checked= and ?deleted=
+    filters; to get the next page, pass the id of the last todo received.
+
+    Responses carry an ETag derived from model.data_version, so polling
+    clients sending If-None-Match get a 304 until something changes."""
+    def set_default_headers(self):
+        self.set_header("Content-Type", "application/x-ndjson")
+
+    def _filters(self):
+        filters = {
+            "after_id": _int_arg(self.get_argument("after_id", None)) or 0,
+            "limit": _int_arg(self.get_argument("limit", None)),
+            "checked": _bool_arg(self.get_argument("checked", None)),
+            "deleted": _bool_arg(self.get_argument("deleted", None))
+        }
+        parent_id = self.get_argument("parent_id", None)
+        if parent_id is not None:
+            filters["parent_id"] = None if parent_id in ("", "null") else int(parent_id)
+        return filters
+
+    async def get(self):
+        try:
+            filters = self._filters()
+        except ValueError as e:
+            self.set_header("Content-Type", "application/json")
+            return self.json({"status": "error", "message": str(e)}, status=400)
+        version = await DB.read(model.data_version)
+        if filters["checked"] is not None and (due := await DB.read(model.upcoming_due)) is not None:
+            # Recurring todos stop counting as checked once they come due,
+            # which changes the response without a write.
+            version = f"{version}-{due:%Y%m%d%H%M%S}"
+        self.set_header("Etag", f'"v{version}"')
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        if (body := RESPONSES.get(self.request.uri, version)) is not None:
+            self.write(body)
+            return
+        chunks, size = [], 0
+        async for page in DB.iter_todo_pages(**filters):
+            chunk = "".join(f"{to_json(todo)}\n" for todo in page).encode()
+            if chunks is not None:
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > RESPONSES.max_body_bytes:
+                    chunks = None
+            self.write(chunk)
+            await self.flush()
+        if chunks is not None:
+            RESPONSES.put(self.request.uri, version, b"".join(chunks))
+
+class ChangesHandler(JSONHandler):
+    """Delta sync. Returns the todos written since data version ?since= and
+    the ids of todos deleted since then, along with the version to send
+    next time. When `more` is true, call again right away with that version."""
+    async def get(self):
+        try:
+            since = _int_arg(self.get_argument("since", None)) or 0
+            limit = _int_arg(self.get_argument("limit", None)) or 500
+        except ValueError as e:
+            return self.json({"status": "error", "message": str(e)}, status=400)
+        self.json({"status": "ok", **(await DB.read(model.changes_since, since, limit))})
+
+class SearchHandler(JSONHandler):
+    """Full-text search over titles and bodies: ?q= (required), ?limit=
+    (default 20) and ?deleted= (default false; empty for everything). Each
+    result has the todo, its rank and the path of ancestors down to it."""
+    async def get(self):
+        query = self.get_argument("q", "")
+        try:
+            limit = _int_arg(self.get_argument("limit", None)) or 20
+            deleted = self.get_argument("deleted", None)
+            deleted = None if deleted == "" else (_bool_arg(deleted) or False)
+        except ValueError as e:
+            return self.json({"status": "error", "message": str(e)}, status=400)
+        if not query.strip():
+            return self.json({"status": "error", "message": "Missing ?q="}, status=400)
+        self.json({"status": "ok", "results": await DB.read(model.search, query, limit, deleted)})
+
+class MetricsHandler(JSONHandler):
+    """Timers, counters and per-statement SQL counts from `metrics`. Pass
+    ?top=N for only the N most expensive entries, ?reset=1 to clear them
+    after reading."""
     def get(self):
-        self.json({
-            "status": "ok",
-            "todos": model.todos()
-        })
+        try:
+            top = _int_arg(self.get_argument("top", None))
+            reset = _bool_arg(self.get_argument("reset", None))
+        except ValueError as e:
+            return self.json({"status": "error", "message": str(e)}, status=400)
+        res = {"status": "ok", **metrics.snapshot(top=top)}
+        if reset:
+            metrics.reset()
+        self.json(res)
 
 
 ROUTES = [
     (r"/v0/health", HealthHandler),
-    (r"/v0/todo", TodoHandler)
+    (r"/v0/todo", TodoHandler),
+    (r"/v0/changes", ChangesHandler),
+    (r"/v0/search", SearchHandler),
+    (r"/v0/metrics", MetricsHandler)
 ]
 
 async def main(port):
     global THREAD
     print("Setting up app...")
+    model.init()
     app = tornado.web.Application(
         ROUTES,
         default_handler_class=TrapCard
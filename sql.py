@@ -1,26 +1,41 @@
-def _where_dict_to_string(where):
-    qstr = " AND ".join(f"{k}=?" for k, v in  where.items())
-    return qstr, tuple(where.values())
+import functools
 
-def _where_arr_to_string(where):
-    queries = []
-    variables = ()
-    for w in where:
-        q, v = _where_to_string(w)
-        queries += [f"({q})"]
-        variables += v
-    return " OR ".join(queries), variables
+# Query text only depends on the "shape" of a call (table, columns, which
+# keys a where clause touches, ...), never on the bound values, so each
+# builder splits its arguments into a hashable shape and an args tuple and
+# memoizes the text per shape. Reusing identical strings is also what lets
+# sqlite3's own statement cache hit.
 
+def _where_shape(where):
+    if isinstance(where, dict):
+        return ("dict", tuple(where.keys()))
+    elif isinstance(where, list):
+        return ("list", tuple(_where_shape(w) for w in where))
+    elif isinstance(where, tuple) and len(where) == 3:
+        return ("op", where[0], where[1])
+    # Dropping it would turn a bad filter into a read of the whole table
+    raise ValueError(f"Unsupported where clause: {where!r}")
 
-def _where_to_string(where):
+def _where_args(where):
     if isinstance(where, dict):
-        return _where_dict_to_string(where)
+        return tuple(where.values())
     elif isinstance(where, list):
-        return _where_arr_to_string(where)
+        return tuple(arg for w in where for arg in _where_args(w))
     elif isinstance(where, tuple) and len(where) == 3:
-        return f"{where[0]} {where[1]} ?", (where[2],)
-    else:
-        return None
+        return (where[2],)
+
+@functools.lru_cache(maxsize=512)
+def _where_text(shape):
+    kind, *rest = shape
+    if kind == "dict":
+        return " AND ".join(f"{k}=?" for k in rest[0])
+    elif kind == "list":
+        return " OR ".join(f"({_where_text(w)})" for w in rest[0])
+    column, op = rest
+    return f"{column} {op} ?"
+
+def _where_to_string(where):
+    return _where_text(_where_shape(where)), _where_args(where)
 
 def join_to_string(join):
     if len(join) == 4:
@@ -31,46 +46,61 @@ def join_to_string(join):
         return f" LEFT JOIN {table} ON {join_from} = {join_to}"
 
 def where_to_string(where):
-    res = _where_to_string(where)
-    if res is not None:
-        qstr, qvars = res
-        return f" WHERE {qstr}", qvars
+    qstr, qvars = _where_to_string(where)
+    return f" WHERE {qstr}", qvars
 
 def createQ(table_name, cols):
     return f"CREATE TABLE IF NOT EXISTS {table_name}({', '.join(cols)})"
 
+@functools.lru_cache(maxsize=256)
+def _insert_text(table_name, keys):
+    return f"INSERT INTO {table_name} ({', '.join(keys)}) VALUES ({', '.join(['?' for k in keys])})"
+
 def insertQ(table_name, **args):
-    ks = args.keys()
-    vs = args.values()
-    return (
-        f"INSERT INTO {table_name} ({', '.join(ks)}) VALUES ({', '.join(['?' for v in vs])})",
-        tuple(vs)
-    )
+    return _insert_text(table_name, tuple(args.keys())), tuple(args.values())
 
-def selectQ(table_name, columns, where=None, join=None, order_by=None):
+def insert_ignoreQ(table_name, **args):
+    query, args = insertQ(table_name, **args)
+    return query.replace("INSERT", "INSERT OR IGNORE", 1), args
+
+@functools.lru_cache(maxsize=512)
+def _select_text(table_name, columns, where_shape, join, order_by):
     query = f"SELECT {', '.join(columns)} FROM {table_name}"
-    args = ()
     if join is not None:
         query += join_to_string(join)
-    if where is not None:
-        where_str, where_args = where_to_string(where)
-        query += where_str
-        args = where_args
+    if where_shape is not None:
+        query += f" WHERE {_where_text(where_shape)}"
     if order_by is not None:
         query += f" ORDER BY {order_by}"
-    return (query, args)
+    return query
 
-def updateQ(table_name, **kwargs):
-    where = kwargs.get('where', None)
-    where_str, where_args = ("", ())
+def selectQ(table_name, columns, where=None, join=None, order_by=None):
+    args = ()
+    where_shape = None
     if where is not None:
-        del kwargs['where']
-        where_str, where_args = where_to_string(where)
-    query = f"UPDATE {table_name} SET {'=?,'.join(kwargs.keys())}=?"
+        where_shape = _where_shape(where)
+        args = _where_args(where)
+    join = tuple(join) if join is not None else None
+    return (_select_text(table_name, tuple(columns), where_shape, join, order_by), args)
+
+@functools.lru_cache(maxsize=256)
+def _update_text(table_name, keys, where_shape):
+    query = f"UPDATE {table_name} SET {'=?,'.join(keys)}=?"
+    if where_shape is not None:
+        query += f" WHERE {_where_text(where_shape)}"
+    return query
 
-    return query + where_str, tuple(kwargs.values()) + where_args
+def updateQ(table_name, **kwargs):
+    where = kwargs.pop('where', None)
+    where_shape, where_args = None, ()
+    if where is not None:
+        where_shape = _where_shape(where)
+        where_args = _where_args(where)
+    return _update_text(table_name, tuple(kwargs.keys()), where_shape), tuple(kwargs.values()) + where_args
 
+@functools.lru_cache(maxsize=256)
+def _delete_text(table_name, where_shape):
+    return f"DELETE FROM {table_name} WHERE {_where_text(where_shape)}"
 
 def deleteQ(table_name, where):
-    where_str, where_args = where_to_string(where)
-    return f"DELETE FROM {table_name} {where_str}", where_args
+    return _delete_text(table_name, _where_shape(where)), _where_args(where)
@@ -0,0 +1,57 @@
+import os
+import tempfile
+import time
+import unittest
+from datetime import datetime, timedelta
+
+import model
+
+
+class StreakTimezoneTest(unittest.TestCase):
+    """todo_streak has to agree with the UTC days todo_stats is kept in, in
+    whatever timezone the app runs."""
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        model.DB_PATH = os.path.join(self.dir.name, "todotree.db")
+        model.use_connection(model.connect())
+        self.addCleanup(lambda: model.conn().close())
+        model.init()
+        self.todo_id = model.bulk_add([{"title": "Exercise", "recurrence": "daily"}])[0]
+        model.todo_update(self.todo_id, check=True)
+        # A zone whose local date differs from the UTC date right now
+        tz = "Etc/GMT-14" if datetime.utcnow().hour >= 10 else "Etc/GMT+12"
+        old_tz = os.environ.get("TZ")
+        os.environ["TZ"] = tz
+        time.tzset()
+        self.addCleanup(self._restore_tz, old_tz)
+        self.assertNotEqual(datetime.now().date(), datetime.utcnow().date())
+
+    def _restore_tz(self, tz):
+        if tz is None:
+            os.environ.pop("TZ", None)
+        else:
+            os.environ["TZ"] = tz
+        time.tzset()
+
+    def _checked_days_ago(self, days):
+        with model.conn() as cur:
+            cur.execute(
+                "UPDATE todo_stats SET streak = 3, last_check_day = date('now', ?) WHERE todo_id = ?",
+                (f"-{days} days", self.todo_id)
+            )
+        model.clear_cache()
+        return model.todo_streak(model.todo_by(self.todo_id))
+
+    def test_checked_today_keeps_streak(self):
+        self.assertEqual(self._checked_days_ago(0), 3)
+
+    def test_checked_yesterday_keeps_streak(self):
+        self.assertEqual(self._checked_days_ago(1), 3)
+
+    def test_gap_breaks_streak(self):
+        self.assertEqual(self._checked_days_ago(2), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()